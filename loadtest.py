@@ -0,0 +1,568 @@
+"""
+End-to-end load test for the verification and dispense flow.
+
+Drives the real handlers in main.py (start, joined_handler, show_account,
+final_verify, generate_code, broadcast) with synthetic Message/CallbackQuery
+objects and a fake client, against a local mongod and a stub shortener HTTP
+server started here. Reports throughput, p50/p99 latency and Mongo round trips
+per flow, and fails (exit 1) when a correctness invariant breaks, e.g. a Gmail
+or code dispensed twice.
+
+    MONGO_URL=mongodb://127.0.0.1:27017 python loadtest.py --users 2000 --concurrency 200
+    python loadtest.py --bench-dispense 1000,10000,100000
+    python loadtest.py --check-memory
+    python loadtest.py --check-state-store
+    python loadtest.py --bench-pool 1,2,4,8
+
+The target database (MONGO_DB, default "ffaccount_loadtest") is dropped first.
+"""
+import os
+import re
+import random
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import collections
+import tracemalloc
+import multiprocessing
+import urllib.parse
+from array import array
+
+# ───────────────── Arguments & environment (before importing main) ───────────────── #
+parser = argparse.ArgumentParser(description="Load-test the bot handlers against local Mongo.")
+parser.add_argument("--users", type=int, default=1000)
+parser.add_argument("--concurrency", type=int, default=100)
+parser.add_argument("--double-tap", type=float, default=0.2, help="share of users that fire final_verify twice at once")
+parser.add_argument("--shortener-latency-ms", type=float, default=50)
+parser.add_argument("--mongo-latency-ms", type=float, default=0, help="extra latency injected into every Mongo call")
+parser.add_argument("--token-mode", choices=["db", "signed"], default="db")
+parser.add_argument("--reserve", action="store_true", help="run the token reserve producer")
+parser.add_argument("--throttle", action="store_true", help="keep the default per-user throttle rules")
+parser.add_argument("--hammer", type=int, default=50, help="concurrent final_verify calls on one token per hammered user")
+parser.add_argument("--hammer-users", type=int, default=20)
+parser.add_argument("--code-workers", type=int, default=4, help="independent code leases, as if that many processes redeemed")
+parser.add_argument("--skip-broadcast", action="store_true")
+parser.add_argument("--bench-dispense", metavar="SIZES", help="only compare the old array-rewrite dispense with pool_items at these pool sizes, e.g. 1000,10000,100000")
+parser.add_argument("--check-memory", action="store_true", help="only check SeenUsers' footprint and lookups at one million ids")
+parser.add_argument("--check-state-store", action="store_true", help="only race MongoStateStore.pop across two processes")
+parser.add_argument("--bench-pool", metavar="COUNTS", help="only measure pool-mode updates/s at these handler process counts, e.g. 1,2,4,8")
+parser.add_argument("--bench-updates", type=int, default=20000, help="updates routed per worker count in --bench-pool")
+parser.add_argument("--bench-handler-ms", type=float, default=1.0, help="CPU time a stand-in handler burns per update in --bench-pool")
+parser.add_argument("--bench-pops", type=int, default=200, help="dispenses timed per pool size in --bench-dispense")
+args = parser.parse_args()
+
+ADMIN_ID = 1
+USER_BASE = 10_000_000
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+STUB_PORT = _free_port()
+os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+os.environ.setdefault("MONGO_DB", "ffaccount_loadtest")
+os.environ.setdefault("BOT_TOKEN", "0:loadtest")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "loadtest")
+os.environ["ADMINS"] = str(ADMIN_ID)
+os.environ["TOKEN_MODE"] = args.token_mode
+os.environ["SHORTENER_PROVIDERS"] = f"stub|http://127.0.0.1:{STUB_PORT}/api?url={{url}}"
+os.environ.setdefault("SLOW_HANDLER_MS", "0")
+os.environ.setdefault("BROADCAST_RATE", "1000")
+os.environ.setdefault("OUTBOUND_RATE", "100000")
+os.environ.setdefault("OUTBOUND_CHAT_RATE", "1000")
+if not args.throttle:
+    os.environ["THROTTLE_RULES"] = ""
+
+from aiohttp import web  # noqa: E402
+from pyrogram import raw, StopPropagation  # noqa: E402
+import main  # noqa: E402
+
+# ───────────────── Stub shortener ───────────────── #
+SHORT_LINKS = {}
+
+async def stub_shorten(request):
+    await asyncio.sleep(args.shortener_latency_ms / 1000)
+    short = f"http://127.0.0.1:{STUB_PORT}/s/{len(SHORT_LINKS)}"
+    SHORT_LINKS[short] = request.query["url"]
+    return web.Response(text=short)
+
+async def start_stub():
+    app = web.Application()
+    app.router.add_get("/api", stub_shorten)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+    return runner
+
+def token_from_url(url: str) -> str:
+    deep_link = SHORT_LINKS.get(url, url)
+    return urllib.parse.parse_qs(urllib.parse.urlparse(deep_link).query)["start"][0][2:]
+
+# ───────────────── Fake Pyrogram objects ───────────────── #
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"user{user_id}"
+
+class FakeMessage:
+    def __init__(self, bot, user_id: int, text: str = "", reply_to_message=None):
+        self._bot = bot
+        self.from_user = FakeUser(user_id)
+        self.chat = self.from_user
+        self.text = text
+        self.caption = None
+        self.document = None
+        self.command = text[1:].split() if text.startswith("/") else None
+        self.reply_to_message = reply_to_message
+        self.reply_markup = None
+
+    async def reply(self, text, reply_markup=None, **kwargs):
+        return await self._bot.send_message(self.from_user.id, text, reply_markup=reply_markup)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        self.text = text
+        self.reply_markup = reply_markup
+        return self
+
+    async def delete(self):
+        return True
+
+class FakeCallbackQuery:
+    def __init__(self, bot, user_id: int, data: str):
+        self.id = str(time.monotonic_ns())
+        self.from_user = FakeUser(user_id)
+        self.data = data
+        self.message = FakeMessage(bot, user_id)
+        self.matches = None
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        self.answers.append(text)
+        return True
+
+class FakeBot:
+    """ Records everything the handlers send, per chat. """
+
+    def __init__(self):
+        self.sent = collections.defaultdict(list)
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        message = FakeMessage(self, chat_id, text)
+        message.reply_markup = reply_markup
+        self.sent[chat_id].append(message)
+        return message
+
+    async def get_me(self):
+        return FakeUser(0)
+
+def last_message(bot: FakeBot, user_id: int) -> FakeMessage:
+    return bot.sent[user_id][-1]
+
+def button(message: FakeMessage, row: int = 0):
+    return message.reply_markup.inline_keyboard[row][0]
+
+# ───────────────── Measurements ───────────────── #
+HANDLER_LATENCY = collections.defaultdict(list)
+HAMMER_FAILURES = []
+
+async def call(handler, bot, update):
+    started = time.perf_counter()
+    try:
+        return await handler(bot, update)
+    finally:
+        HANDLER_LATENCY[handler.__name__].append(time.perf_counter() - started)
+
+def mongo_calls() -> int:
+    return sum(int(series[-1]) for series in main.MONGO_SECONDS._series.values())
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.mongo = 0
+        self.elapsed = 0.0
+
+# ───────────────── Flows ───────────────── #
+async def account_flow(bot: FakeBot, user_id: int, server: str, double_tap: bool):
+    await call(main.start, bot, FakeMessage(bot, user_id, "/start"))
+    await call(main.joined_handler, bot, FakeCallbackQuery(bot, user_id, "joined"))
+    await call(main.find_accounts, bot, FakeCallbackQuery(bot, user_id, "find_accounts"))
+    await call(main.server_selected, bot, FakeCallbackQuery(bot, user_id, f"server:{server}"))
+    await call(main.show_account, bot, FakeCallbackQuery(bot, user_id, f"show_account:{server}"))
+    token = token_from_url(button(last_message(bot, user_id)).url)
+    await call(main.start, bot, FakeMessage(bot, user_id, f"/start GL{token}"))
+    data = button(last_message(bot, user_id)).callback_data
+    taps = 2 if double_tap else 1
+    await asyncio.gather(*(call(main.final_verify, bot, FakeCallbackQuery(bot, user_id, data)) for _ in range(taps)))
+
+async def redeem_flow(bot: FakeBot, user_id: int, double_tap: bool):
+    await call(main.generate_code, bot, FakeCallbackQuery(bot, user_id, "gen_code"))
+    token = token_from_url(button(last_message(bot, user_id)).url)
+    await call(main.start, bot, FakeMessage(bot, user_id, f"/start GL{token}"))
+    data = button(last_message(bot, user_id)).callback_data
+    taps = 2 if double_tap else 1
+    await asyncio.gather(*(call(main.final_verify, bot, FakeCallbackQuery(bot, user_id, data)) for _ in range(taps)))
+
+async def hammer_flow(bot: FakeBot, user_id: int, server: str):
+    """ One token, many simultaneous final_verify calls: exactly one may dispense. """
+    await call(main.show_account, bot, FakeCallbackQuery(bot, user_id, f"show_account:{server}"))
+    token = token_from_url(button(last_message(bot, user_id)).url)
+    queries = [FakeCallbackQuery(bot, user_id, f"final_verify:{token}") for _ in range(args.hammer)]
+    await asyncio.gather(*(call(main.final_verify, bot, q) for q in queries))
+    winners = sum(1 for q in queries if "Verified ✅" in q.answers)
+    if winners != 1:
+        HAMMER_FAILURES.append(f"token {token}: {winners} of {args.hammer} concurrent final_verify calls succeeded")
+
+async def run_phase(name: str, make_flow, count: int) -> Phase:
+    phase = Phase(name)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await make_flow(i)
+            except Exception as e:
+                phase.errors += 1
+                if phase.errors <= 5:
+                    print(f"  {name} flow {i} failed: {e!r}", file=sys.stderr)
+                return
+            phase.latencies.append(time.perf_counter() - started)
+
+    before = mongo_calls()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    phase.elapsed = time.perf_counter() - started
+    phase.mongo = mongo_calls() - before
+    return phase
+
+async def broadcast_phase(bot: FakeBot) -> Phase:
+    phase = Phase("broadcast")
+    await main.user_writer.flush()
+    before = mongo_calls()
+    started = time.perf_counter()
+    await main.broadcast(bot, FakeMessage(bot, ADMIN_ID, "/broadcast load test"))
+    while main.BROADCAST_TASKS:
+        await asyncio.sleep(0.05)
+    phase.elapsed = time.perf_counter() - started
+    phase.latencies.append(phase.elapsed)
+    phase.mongo = mongo_calls() - before
+    return phase
+
+# ───────────────── Setup, invariants, report ───────────────── #
+def seed(users: int):
+    main.client.drop_database(main.MONGO_DB)
+    main.ensure_schema()
+    for region in main.DEFAULT_REGIONS:
+        main._insert_pool_values_sync(region["pool"], [f"{region['_id']}{i}@loadtest.dev" for i in range(users + args.hammer_users)])
+    main._insert_pool_values_sync(main.CODES_POOL, [f"CODE{i:08d}" for i in range(users)])
+
+def check_invariants(bot: FakeBot, users: int) -> list:
+    failures = []
+    gmails, codes = collections.Counter(), collections.Counter()
+    for messages in bot.sent.values():
+        for message in messages:
+            gmails.update(re.findall(r"Gmail: `([^`]+)`", message.text or ""))
+            codes.update(re.findall(r"Redeem Code:- (\S+)", message.text or ""))
+    for label, seen, pool_filter in (
+        ("gmail", gmails, {"pool": {"$ne": main.CODES_POOL}}),
+        ("code", codes, {"pool": main.CODES_POOL}),
+    ):
+        repeated = [v for v, n in seen.items() if n > 1]
+        if repeated:
+            failures.append(f"{len(repeated)} {label}s dispensed more than once, e.g. {repeated[:3]}")
+        stored = main.pool_items_collection.count_documents({**pool_filter, "status": main.POOL_DISPENSED})
+        if stored != len(seen):
+            failures.append(f"{stored} {label}s marked dispensed in Mongo but {len(seen)} sent to users")
+    failures.extend(HAMMER_FAILURES)
+    leased = main.pool_items_collection.count_documents({"status": main.POOL_LEASED})
+    if leased:
+        failures.append(f"{leased} codes still leased after every worker released its lease")
+    codes_total = main.pool_items_collection.count_documents({"pool": main.CODES_POOL})
+    if codes_total != users:
+        failures.append(f"{codes_total} codes stored, {users} seeded (codes lost or duplicated)")
+    if len(gmails) > users + args.hammer_users:
+        failures.append(f"{len(gmails)} gmails sent to {users + args.hammer_users} users (one each expected)")
+    if len(codes) > users:
+        failures.append(f"{len(codes)} codes sent to {users} users (one each expected)")
+    return failures
+
+def report(phases, failures):
+    print(f"\n{'flow':<10} {'ok':>7} {'err':>5} {'flows/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'mongo/flow':>11}")
+    for phase in phases:
+        ok = len(phase.latencies)
+        print(f"{phase.name:<10} {ok:>7} {phase.errors:>5} {ok / max(phase.elapsed, 1e-9):>9.1f} "
+              f"{percentile(phase.latencies, 50) * 1000:>9.1f} {percentile(phase.latencies, 99) * 1000:>9.1f} "
+              f"{phase.mongo / max(ok, 1):>11.1f}")
+    print(f"\n{'handler':<18} {'calls':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, values in sorted(HANDLER_LATENCY.items()):
+        print(f"{name:<18} {len(values):>7} {percentile(values, 50) * 1000:>9.1f} {percentile(values, 99) * 1000:>9.1f}")
+    print("\ninvariants: " + ("OK" if not failures else "FAILED"))
+    for failure in failures:
+        print(f"  - {failure}")
+
+async def run():
+    if args.mongo_latency_ms:
+        plain_run_db = main.run_db
+
+        async def slow_run_db(fn, *a, **kw):
+            def delayed():
+                time.sleep(args.mongo_latency_ms / 1000)
+                return fn(*a, **kw)
+            delayed.__name__ = getattr(fn, "__name__", "call")
+            return await plain_run_db(delayed)
+        main.run_db = slow_run_db
+
+    stub = await start_stub()
+    await asyncio.get_running_loop().run_in_executor(None, seed, args.users)
+    main.BOT_USERNAME = "loadtest_bot"
+    main.lifecycle.ready.set()
+    main.user_writer.start()
+    main.outbox.start()
+    # Several leases against one pool stand in for several worker processes.
+    code_workers = [
+        main.CodeLease(main.CODES_POOL, main.CODE_LEASE_BATCH, main.CODE_LEASE_LOW, main.CODE_LEASE_TTL)
+        for _ in range(max(args.code_workers, 1))
+    ]
+    main.get_current_code = lambda: random.choice(code_workers).take()
+    if args.reserve:
+        main.token_reserve.start()
+    bot = FakeBot()
+    regions = [r["_id"] for r in await main.get_regions()]
+    every = int(1 / args.double_tap) if args.double_tap > 0 else 0
+
+    phases = [
+        await run_phase("account", lambda i: account_flow(
+            bot, USER_BASE + i, regions[i % len(regions)], bool(every) and i % every == 0), args.users),
+        await run_phase("redeem", lambda i: redeem_flow(
+            bot, USER_BASE + i, bool(every) and i % every == 0), args.users),
+    ]
+    if args.hammer > 1:
+        phases.append(await run_phase("hammer", lambda i: hammer_flow(
+            bot, USER_BASE + args.users + i, regions[i % len(regions)]), args.hammer_users))
+    if not args.skip_broadcast:
+        phases.append(await broadcast_phase(bot))
+
+    await main.token_reserve.stop()
+    await main.user_writer.stop()
+    await main.shortener.close()
+    await main.outbox.stop()
+    await asyncio.gather(*(worker.stop() for worker in code_workers))
+    await stub.cleanup()
+    failures = await asyncio.get_running_loop().run_in_executor(None, check_invariants, bot, args.users)
+    report(phases, failures)
+    return 1 if failures else 0
+
+# ───────────────── Dispense benchmark ───────────────── #
+def legacy_pop(key: str):
+    """ The dispense pool_items replaced: load the whole config array, pop the head, write it all back. """
+    lst = (main.config_collection.find_one({"_id": key}) or {}).get("list", [])
+    if not lst:
+        return None
+    value = lst.pop(0)
+    main.config_collection.update_one({"_id": key}, {"$set": {"list": lst}}, upsert=True)
+    return value
+
+async def bench_dispense(sizes) -> int:
+    main.client.drop_database(main.MONGO_DB)
+    main.ensure_schema()
+    print(f"{'pool size':>10} {'path':<8} {'p50 ms':>9} {'p99 ms':>9}")
+    failures = []
+    for size in sizes:
+        values = [f"bench{size}_{i}@loadtest.dev" for i in range(size)]
+        main.config_collection.update_one({"_id": f"legacy{size}"}, {"$set": {"list": values}}, upsert=True)
+        main._insert_pool_values_sync(f"bench{size}", values)
+        timings = {"array": [], "items": []}
+        for _ in range(min(args.bench_pops, size)):
+            started = time.perf_counter()
+            legacy = legacy_pop(f"legacy{size}")
+            timings["array"].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            item = await main.pop_from_pool(f"bench{size}")
+            timings["items"].append(time.perf_counter() - started)
+            if legacy != item:
+                failures.append(f"size {size}: array path gave {legacy}, pool_items gave {item}")
+        for path, values in timings.items():
+            print(f"{size:>10} {path:<8} {percentile(values, 50) * 1000:>9.2f} {percentile(values, 99) * 1000:>9.2f}")
+    for failure in failures[:5]:
+        print(f"  - {failure}")
+    return 1 if failures else 0
+
+# ───────────────── SeenUsers memory check ───────────────── #
+def check_memory(users: int = 1_000_000) -> int:
+    """ The documented ~8 MB per million users, measured, plus exact lookups around a merge. """
+    rng = random.Random(9)
+    ids = sorted(rng.sample(range(1, 8_000_000_000), users + 20_000))
+    loaded, fresh = ids[:users], ids[users:]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    seen = main.SeenUsers(merge_at=10_000)
+    seen.load(array("q", loaded))
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    failures = []
+    print(f"{users} ids: nbytes {seen.nbytes() / 1e6:.2f} MB, allocated {allocated / 1e6:.2f} MB")
+    if not 7.5e6 <= seen.nbytes() <= 9e6:
+        failures.append(f"nbytes() is {seen.nbytes()} for {users} ids, ~8 MB documented")
+    if allocated > 9e6:
+        failures.append(f"loading {users} ids allocated {allocated} bytes, ~8 MB documented")
+    for uid in fresh[:15_000]:  # crosses merge_at once
+        seen.add(uid)
+    present = rng.sample(loaded, 10_000) + fresh[:15_000]
+    known = set(ids)
+    absent = [uid + 1 for uid in rng.sample(ids, 10_000) if uid + 1 not in known] + fresh[15_000:] + [0, -1]
+    missing = [uid for uid in present if uid not in seen]
+    phantom = [uid for uid in absent if uid in seen]
+    if missing:
+        failures.append(f"{len(missing)} known ids not found, e.g. {missing[:3]}")
+    if phantom:
+        failures.append(f"{len(phantom)} unknown ids reported seen, e.g. {phantom[:3]}")
+    if len(seen) != users + 15_000:
+        failures.append(f"len() is {len(seen)}, expected {users + 15_000}")
+    print("invariants: " + ("OK" if not failures else "FAILED"))
+    for failure in failures:
+        print(f"  - {failure}")
+    return 1 if failures else 0
+
+# ───────────────── Cross-process conversation state ───────────────── #
+async def _pop_all(user_ids) -> dict:
+    store = main.MongoStateStore()
+    states = await asyncio.gather(*(store.pop(uid) for uid in user_ids))
+    return {uid: state for uid, state in zip(user_ids, states) if state is not None}
+
+def _pop_worker(user_ids, barrier, results):
+    barrier.wait()  # both processes start popping together
+    results.put(asyncio.run(_pop_all(user_ids)))
+
+async def check_state_store(users: int = 500) -> int:
+    """ State set in this process, popped by two others at once: one winner each, nothing expired. """
+    store = main.MongoStateStore()
+    live = list(range(USER_BASE, USER_BASE + users))
+    expired = list(range(USER_BASE + users, USER_BASE + 2 * users))
+    await main.run_db(main.conversation_state_collection.delete_many, {"_id": {"$in": live + expired}})
+    await asyncio.gather(*(store.set(uid, "stale", 0.5) for uid in expired))
+    await asyncio.gather(*(store.set(uid, f"state{uid}", 60) for uid in live))
+    await asyncio.sleep(1)  # well before the TTL monitor's next pass
+
+    ctx = multiprocessing.get_context("spawn")
+    barrier, results = ctx.Barrier(2), ctx.Queue()
+    workers = [ctx.Process(target=_pop_worker, args=(live + expired, barrier, results)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    loop = asyncio.get_running_loop()
+    won = [await loop.run_in_executor(None, results.get, True, 120) for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    failures = []
+    wins = collections.Counter(uid for popped in won for uid in popped)
+    print(f"{users} live states popped by 2 processes: {len(won[0])} / {len(won[1])}")
+    lost = [uid for uid in live if wins[uid] == 0]
+    doubled = [uid for uid in live if wins[uid] > 1]
+    stale = [uid for uid in expired if wins[uid]]
+    wrong = [uid for popped in won for uid, state in popped.items() if uid in live and state != f"state{uid}"]
+    if lost:
+        failures.append(f"{len(lost)} states popped by nobody, e.g. {lost[:3]}")
+    if doubled:
+        failures.append(f"{len(doubled)} states popped by both processes, e.g. {doubled[:3]}")
+    if stale:
+        failures.append(f"{len(stale)} expired states returned, e.g. {stale[:3]}")
+    if wrong:
+        failures.append(f"{len(wrong)} states came back altered, e.g. {wrong[:3]}")
+    if await store.get(expired[0]) is not None or await store.get(live[0]) is not None:
+        failures.append("get() returned an expired or already popped state")
+    print("invariants: " + ("OK" if not failures else "FAILED"))
+    for failure in failures:
+        print(f"  - {failure}")
+    return 1 if failures else 0
+
+# ───────────────── Pool-mode throughput ───────────────── #
+def _bench_update(i: int):
+    user_id = USER_BASE + i % 1000
+    peer = raw.types.PeerUser(user_id=user_id)
+    message = raw.types.Message(
+        id=i + 1, peer_id=peer, from_id=peer, date=int(time.time()), message="/start",
+        entities=[raw.types.MessageEntityBotCommand(offset=0, length=6)]
+    )
+    user = raw.types.User(id=user_id, access_hash=user_id, first_name="load")
+    return raw.types.UpdateNewMessage(message=message, pts=i + 1, pts_count=1), {user_id: user}, {}
+
+def _bench_pool_worker(q, done, handler_ms: float):
+    """ A handler process minus Telegram: decode, parse like pump_updates, then burn handler_ms of CPU. """
+    async def work():
+        parsers = main.Bot.dispatcher.update_parsers
+        done.put("ready")
+        handled = 0
+        while True:
+            packet = q.get()
+            if packet is None:
+                return handled
+            update, users, chats = main.decode_update(packet)
+            await parsers[type(update)](update, {u.id: u for u in users}, {c.id: c for c in chats})
+            until = time.perf_counter() + handler_ms / 1000
+            while time.perf_counter() < until:
+                pass
+            handled += 1
+    done.put(asyncio.run(work()))
+
+async def bench_pool(counts) -> int:
+    """ Updates/s through HandlerPool.route (the receiver's real routing) and N handler processes. """
+    packets = [_bench_update(i) for i in range(args.bench_updates)]
+    ctx = multiprocessing.get_context("spawn")
+    loop = asyncio.get_running_loop()
+    failures = []
+    print(f"{'workers':>8} {'updates/s':>10} {'routed/s':>10}")
+    for n in counts:
+        pool = main.HandlerPool(n, len(packets))
+        done = ctx.Queue()
+        for i in range(n):
+            pool.queues[i] = ctx.Queue(len(packets))
+            pool.processes[i] = ctx.Process(
+                target=_bench_pool_worker, args=(pool.queues[i], done, args.bench_handler_ms), name=f"bench-{i}"
+            )
+            pool.processes[i].start()
+        for _ in range(n):  # don't time the imports
+            await loop.run_in_executor(None, done.get)
+        started = time.perf_counter()
+        for update, users, chats in packets:
+            try:
+                await pool.route(None, update, users, chats)
+            except StopPropagation:
+                pass
+        routed = time.perf_counter() - started
+        for q in pool.queues:
+            q.put(None)
+        handled = 0
+        for _ in range(n):
+            handled += await loop.run_in_executor(None, done.get)
+        elapsed = time.perf_counter() - started
+        for process in pool.processes:
+            process.join()
+        print(f"{n:>8} {len(packets) / elapsed:>10.0f} {len(packets) / routed:>10.0f}")
+        if handled != len(packets):
+            failures.append(f"{n} workers handled {handled} of {len(packets)} updates")
+    for failure in failures:
+        print(f"  - {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    if args.bench_pool:
+        sys.exit(asyncio.run(bench_pool([int(n) for n in args.bench_pool.split(",")])))
+    if args.check_state_store:
+        sys.exit(asyncio.run(check_state_store()))
+    if args.check_memory:
+        sys.exit(check_memory())
+    if args.bench_dispense:
+        sys.exit(asyncio.run(bench_dispense([int(n) for n in args.bench_dispense.split(",")])))
+    sys.exit(asyncio.run(run()))
@@ -1,41 +1,431 @@
+import io
 import os
+import re
+import csv
+import codecs
+import tempfile
+import sys
+import time
+import signal
+import logging
 import threading
+import hmac
+import base64
+import hashlib
 import random
+import secrets
 import string
+import heapq
+import queue
+import struct
+import bisect
+from array import array
 import asyncio
+import functools
+import collections
+import multiprocessing
 import aiohttp
 import urllib.parse
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from pyrogram import Client, filters
-from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ForceReply
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from pyrogram import Client, filters, raw, StopPropagation, ContinuePropagation
+from pyrogram.enums import ChatMemberStatus
+from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated, UserDeactivated, PeerIdInvalid, UserNotParticipant
+from pyrogram.handlers import MessageHandler, CallbackQueryHandler
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ForceReply, CallbackQuery
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure, BulkWriteError
+from bson import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 
 load_dotenv()
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("ffaccount")
+
+# ───────────────── Metrics ───────────────── #
+# Minimal Prometheus text-format registry; rendered by /metrics.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = []
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = collections.defaultdict(float)
+        METRICS.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] += amount
+
+    def _samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{_label_str(self.labelnames, labels)} {value:g}")
+        return lines
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        self._values[labels] -= amount
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def _samples(self):
+        for labels, series in self._series.items():
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket", labels + (f"{bound:g}",), count
+            yield f"{self.name}_bucket", labels + ("+Inf",), series[-1]
+            yield f"{self.name}_sum", labels, series[-2]
+            yield f"{self.name}_count", labels, series[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self._samples():
+            names = self.labelnames + ("le",) if name.endswith("_bucket") else self.labelnames
+            lines.append(f"{name}{_label_str(names, labels)} {value:g}")
+        return lines
+
+def _label_str(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers that raised", ("handler",))
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Updates currently being handled")
+MONGO_SECONDS = Histogram("bot_mongo_call_seconds", "Mongo call latency", ("op",))
+SHORTENER_SECONDS = Histogram("bot_shortener_call_seconds", "Shortener call latency", ("provider", "outcome"))
+
+# ───────────────── Lifecycle ───────────────── #
+# Startup flips `lifecycle.ready` once Mongo, Telegram and the caches are up;
+# updates that arrive earlier wait for it (up to STARTUP_GATE_TIMEOUT). On
+# SIGTERM the process stops accepting updates, lets in-flight handlers finish
+# and flushes buffered writes, all within SHUTDOWN_DEADLINE (Heroku kills the
+# dyno 30s after SIGTERM).
+PROCESS_STARTED = time.monotonic()
+STARTUP_GATE_TIMEOUT = float(os.getenv("STARTUP_GATE_TIMEOUT", "30"))
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "25"))
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Time spent in each startup phase", ("phase",))
+UPDATES_REJECTED = Counter("bot_updates_rejected_total", "Updates turned away while starting or draining", ("reason",))
+
+class Lifecycle:
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.draining = False
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def enter(self):
+        self.in_flight += 1
+        self._idle.clear()
+
+    def leave(self):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self._idle.set()
+
+    async def drained(self, timeout: float) -> bool:
+        """ True once no handler is running, False if timeout passes first. """
+        try:
+            await asyncio.wait_for(self._idle.wait(), max(timeout, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+lifecycle = Lifecycle()
+
+_background = set()  # fire-and-forget tasks, held until done (see spawn)
+
+def _reap(task: asyncio.Task):
+    _background.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("background task %s failed", task.get_name(), exc_info=task.exception())
+
+def spawn(coro, name: str = None) -> asyncio.Task:
+    """ create_task for work nobody awaits: keeps a reference until it finishes and logs a failure. """
+    task = asyncio.create_task(coro, name=name)
+    _background.add(task)
+    task.add_done_callback(_reap)
+    return task
+
+class BackgroundTask:
+    """ A component's long-running coroutine: start() runs it unless it already is, stop() cancels and waits. """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._factory())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+# ───────────────── Profiling ───────────────── #
+# /profile starts an AsyncSampler thread for N seconds; nothing runs while it
+# is off. Separately, handlers slower than SLOW_HANDLER_MS log where they are
+# currently awaiting (one call_later per update, 0 disables it).
+SLOW_HANDLER_MS = float(os.getenv("SLOW_HANDLER_MS", "3000"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+def _frame_label(code, lineno) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+def coro_stack(coro) -> list:
+    """ Outermost-first await chain of a suspended coroutine. """
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is not None:
+            frames.append(_frame_label(frame.f_code, frame.f_lineno))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+class AsyncSampler:
+    """
+    Samples the event loop from a side thread. Each tick records:
+      - "cpu": the loop thread's Python stack, under the name of the running task
+        ("idle" when the loop is waiting in select);
+      - "await": every suspended task's await chain, i.e. where wall time goes
+        while handlers wait on Mongo, the shortener or Telegram.
+    Output is in folded-stack format (flamegraph.pl / speedscope).
+    """
+
+    def __init__(self, loop, interval: float):
+        self.loop = loop
+        self.interval = interval
+        self.thread_id = threading.get_ident()  # constructed on the loop thread
+        self.folded = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+
+    def _sample_cpu(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        stack.reverse()
+        task = asyncio.current_task(self.loop)
+        if task is None and stack and "select" in stack[-1]:
+            self.folded["cpu;idle"] += 1
+            return
+        name = task.get_name() if task else "loop"
+        self.folded[";".join(["cpu", name] + stack)] += 1
+
+    def _sample_await(self):
+        try:
+            tasks = asyncio.all_tasks(self.loop)
+        except RuntimeError:
+            return
+        running = asyncio.current_task(self.loop)
+        for task in tasks:
+            if task is running or task.done():
+                continue
+            chain = coro_stack(task.get_coro())
+            if chain:
+                self.folded[";".join(["await", task.get_name()] + chain)] += 1
+
+    def run(self, seconds: float):
+        # A short GIL switch interval lets this thread interrupt CPU-bound loop
+        # work instead of only ever waking up while the loop sits in select.
+        old_switch = sys.getswitchinterval()
+        sys.setswitchinterval(min(old_switch, self.interval / 10))
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline and not self._stop.is_set():
+                self._sample_cpu()
+                self._sample_await()
+                self.samples += 1
+                time.sleep(self.interval)
+        finally:
+            sys.setswitchinterval(old_switch)
+
+    def hot_spots(self, kind: str, limit: int = 10):
+        leaves = collections.Counter()
+        for stack, count in self.folded.items():
+            parts = stack.split(";")
+            if parts[0] == kind and len(parts) > 2:
+                leaves[parts[-1]] += count
+        return leaves.most_common(limit)
+
+    def folded_text(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.folded.most_common()) + "\n"
+
+_profile_lock = asyncio.Lock()
+
+def _log_slow_handler(task, name: str, started: float):
+    chain = coro_stack(task.get_coro()) if not task.done() else []
+    log.warning(
+        "slow handler %s: %.0f ms and still running; awaiting:\n  %s",
+        name, (time.monotonic() - started) * 1000, "\n  ".join(chain) or "<unknown>"
+    )
+
+async def _turn_away(update, reason: str):
+    UPDATES_REJECTED.inc(reason)
+    if reason != "draining":
+        return
+    # Only a restart gets here; the next process will handle the retry.
+    try:
+        if hasattr(update, "data"):
+            await update.answer("♻️ Bot is restarting. Please tap again in a few seconds.")
+        else:
+            await update.reply("♻️ Bot is restarting. Please send that again in a few seconds.")
+    except Exception:
+        pass
+
+def instrumented(name: str):
+    """
+    Handler decorator: readiness gate, drain tracking, latency histogram, error
+    counter, in-flight gauge and slow-handler traces.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(bot, update):
+            if not lifecycle.ready.is_set() and not lifecycle.draining:
+                try:
+                    await asyncio.wait_for(lifecycle.ready.wait(), STARTUP_GATE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return await _turn_away(update, "starting")
+            lifecycle.enter()
+            UPDATES_IN_FLIGHT.inc()
+            started = time.monotonic()
+            watchdog = None
+            if SLOW_HANDLER_MS > 0:
+                watchdog = asyncio.get_running_loop().call_later(
+                    SLOW_HANDLER_MS / 1000, _log_slow_handler, asyncio.current_task(), name, started
+                )
+            try:
+                return await func(bot, update)
+            except (StopPropagation, ContinuePropagation):
+                raise
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                elapsed = time.monotonic() - started
+                if watchdog is not None:
+                    watchdog.cancel()
+                    if elapsed * 1000 > SLOW_HANDLER_MS:
+                        log.warning("slow handler %s finished in %.0f ms", name, elapsed * 1000)
+                HANDLER_SECONDS.observe(elapsed, name)
+                if name in FUNNEL_STEPS:
+                    analytics.track(funnel_step(name, update), update.from_user.id, elapsed)
+                UPDATES_IN_FLIGHT.dec()
+                lifecycle.leave()
+        return wrapper
+    return decorator
+
 # ───────────────── MongoDB ───────────────── #
 MONGO_URL = os.getenv("MONGO_URL")
-client = MongoClient(MONGO_URL)
-db = client["telegram_bot"]
+MONGO_DB = os.getenv("MONGO_DB", "telegram_bot")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+# pymongo is blocking, so every call runs on this bounded pool instead of the
+# event loop. Keep it <= MONGO_MAX_POOL_SIZE so threads never wait on sockets.
+MONGO_WORKERS = int(os.getenv("MONGO_WORKERS", "16"))
+# connect=False: no sockets or monitor threads until the first operation, so
+# importing this module (workers, loadtest.py) is instant and fork-safe.
+client = MongoClient(MONGO_URL, maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE, connect=False)
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_WORKERS, thread_name_prefix="mongo")
+db = client[MONGO_DB]
 config_collection = db["config"]
 users_collection = db["users"]
 tokens_collection = db["tokens"]  # for verification tokens
+broadcasts_collection = db["broadcasts"]  # broadcast jobs + checkpoints
+used_tokens_collection = db["used_tokens"]  # single-use guard for signed tokens (TTL)
+conversation_state_collection = db["conversation_state"]  # shared per-user prompts (TTL)
+regions_collection = db["regions"]  # server/region registry
+throttle_collection = db["throttle"]  # shared token buckets (THROTTLE_BACKEND=mongo)
+pool_items_collection = db["pool_items"]  # one document per Gmail pool entry
+events_collection = db["events"]  # funnel events (time-series, TTL)
+funnel_daily_collection = db["funnel_daily"]  # pre-aggregated funnel rollups per (day, step, server)
 # --- New Key Collection/Document ---
 # We'll use config_collection for the admin key
 ADMIN_KEY_CONFIG_ID = "admin_login_key"
 
 ADMINS = [int(i) for i in os.getenv("ADMINS", "2117119246").split()]
 
+async def run_db(fn, *args, **kwargs):
+    """ Run a blocking pymongo call on the Mongo thread pool and await its result. """
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        return await loop.run_in_executor(mongo_executor, functools.partial(fn, *args, **kwargs))
+    finally:
+        MONGO_SECONDS.observe(time.monotonic() - started, getattr(fn, "__name__", "call"))
+
 # ───────────────── Bot ───────────────── #
+# DEPLOY_MODE=pool: this process only receives updates and hands them to
+# DEPLOY_WORKERS handler processes (see "Handler process pool"). Each handler
+# process imports this module with BOT_ROLE=worker and gets its own session.
+DEPLOY_MODE = os.getenv("DEPLOY_MODE", "single")  # "single" or "pool"
+DEPLOY_WORKERS = int(os.getenv("DEPLOY_WORKERS", str(os.cpu_count() or 2)))
+# Handler processes are spawned as "handler-<index>". Spawn re-imports this
+# module before the Process args are unpickled, so the name is what tells it
+# which role to take (see HandlerPool._spawn).
+_HANDLER_PROCESS = re.fullmatch(r"handler-(\d+)", multiprocessing.current_process().name)
+if _HANDLER_PROCESS:
+    BOT_ROLE, WORKER_INDEX = "worker", int(_HANDLER_PROCESS.group(1))
+else:
+    BOT_ROLE, WORKER_INDEX = ("receiver" if DEPLOY_MODE == "pool" else "single"), 0
+HANDLES_UPDATES = BOT_ROLE != "receiver"
+
+_bot_options = {}
+if BOT_ROLE == "worker":
+    _bot_options["no_updates"] = True
+elif BOT_ROLE == "receiver":
+    _bot_options["workers"] = 1  # parse and route strictly in arrival order
 Bot = Client(
-    "Play-Store-Bot",
+    "Play-Store-Bot" if BOT_ROLE != "worker" else f"Play-Store-Bot-w{WORKER_INDEX}",
     bot_token=os.environ["BOT_TOKEN"],
     api_id=int(os.environ["API_ID"]),
-    api_hash=os.environ["API_HASH"]
+    api_hash=os.environ["API_HASH"],
+    **_bot_options
 )
 HOW_TO_VERIFY_URL = "https://t.me/kpslinkteam/52"
-FORCE_SUB_LINKS = [
+# Seeds the force_sub config document (migration 5); edit with /forcesub.
+DEFAULT_FORCE_SUB_LINKS = [
     "https://t.me/+Iyc7cjYrBpxlOWM1",
     "https://t.me/+b-IG273R1QhiN2Rl",
     "https://t.me/+JJdz2hyOVRYyNzE1",
@@ -45,55 +435,510 @@ FORCE_SUB_LINKS = [
 # ───────────────── AroLinks API ───────────────── #
 AROLINKS_API = "7a04b0ba40696303483cd4be8541a1a8d831141f"
 
+# Shortener backends as "name|url_template" entries separated by commas. The
+# template gets {url} (the quoted deep link); AroLinks is the default.
+SHORTENER_PROVIDERS = os.getenv(
+    "SHORTENER_PROVIDERS",
+    f"arolinks|https://arolinks.com/api?api={AROLINKS_API}&url={{url}}&format=text"
+)
+SHORTENER_ROUTING = os.getenv("SHORTENER_ROUTING", "latency")  # "latency" or "hedged"
+SHORTENER_CONNECT_TIMEOUT = float(os.getenv("SHORTENER_CONNECT_TIMEOUT", "1.5"))
+SHORTENER_READ_TIMEOUT = float(os.getenv("SHORTENER_READ_TIMEOUT", "3"))
+SHORTENER_DEADLINE = float(os.getenv("SHORTENER_DEADLINE", "4"))  # whole shorten() call
+SHORTENER_HEDGE_DELAY = float(os.getenv("SHORTENER_HEDGE_DELAY", "0.6"))
+SHORTENER_POOL_SIZE = int(os.getenv("SHORTENER_POOL_SIZE", "100"))
+SHORTENER_BREAKER_FAILURES = int(os.getenv("SHORTENER_BREAKER_FAILURES", "3"))
+SHORTENER_BREAKER_COOLDOWN = float(os.getenv("SHORTENER_BREAKER_COOLDOWN", "30"))
+
+# ───────────────── Config cache ───────────────── #
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", "60"))
+# Follow MongoDB change streams so other processes' writes invalidate this
+# cache right away. Needs a replica set (a single-node one is enough).
+CONFIG_WATCH = os.getenv("CONFIG_WATCH", "0") == "1"
+
+class ConfigCache:
+    """
+    Read-through cache for config values (admin key, codes count, pool sizes).
+    Entries expire after a TTL and are dropped immediately by the writers in
+    this process, or by the change-stream watcher for writes made elsewhere.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}  # key -> (expires_at, value)
+        self._generations = collections.Counter()  # key -> invalidations so far
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self._watcher = None
+        self._stop_watch = threading.Event()
+
+    async def get(self, key: str, loader):
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            self.hits[key] += 1
+            return entry[1]
+        self.misses[key] += 1
+        generation = self._generations.setdefault(key, 0)  # registered, so prefix/clear see it
+        value = await loader()
+        # Invalidated while loading: the value may predate that write, so don't keep it.
+        if self._generations[key] == generation:
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self._generations[key] += 1
+            self._entries.pop(key, None)
+
+    def adjust(self, key: str, delta: int):
+        """ Apply a known change to a cached count in place (no reload); a no-op when not cached. """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = (entry[0], entry[1] + delta)
+
+    def invalidate_prefix(self, prefix: str):
+        self.invalidate(*[k for k in self._generations if k.startswith(prefix)])
+
+    def clear(self):
+        self.invalidate(*list(self._generations))
+
+    def _on_change(self, change: dict):
+        coll = change.get("ns", {}).get("coll")
+        if coll == "config":
+            self.invalidate(str(change.get("documentKey", {}).get("_id")))
+        elif coll == "pool_items":
+            self.invalidate_prefix("pool_size:")
+        elif coll == "regions":
+            self.invalidate("regions")
+        else:
+            self.clear()  # invalidate / drop events
+
+    def _watch_sync(self, loop):
+        # pool_items updates are dispenses and leases in other processes: the
+        # TTL absorbs that drift. Its inserts and deletes (uploads, replaces) get through.
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": ["config", "pool_items", "regions"]},
+            "$nor": [{"ns.coll": "pool_items", "operationType": "update"}],
+        }}]
+        while not self._stop_watch.is_set():
+            try:
+                with db.watch(pipeline, max_await_time_ms=1000) as stream:
+                    loop.call_soon_threadsafe(self.clear)  # may have missed events while down
+                    while not self._stop_watch.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            loop.call_soon_threadsafe(self._on_change, change)
+            except Exception as e:
+                log.warning("config change stream failed: %s", e)
+                self._stop_watch.wait(5)
+
+    def start_watch(self):
+        if self._watcher is None:
+            loop = asyncio.get_running_loop()
+            self._watcher = threading.Thread(target=self._watch_sync, args=(loop,), name="config-watch", daemon=True)
+            self._watcher.start()
+
+    def stop_watch(self):
+        self._stop_watch.set()
+
+    def stats(self) -> dict:
+        return {
+            "hits": sum(self.hits.values()),
+            "misses": sum(self.misses.values()),
+            "keys": {k: (self.hits[k], self.misses[k]) for k in sorted(set(self.hits) | set(self.misses))},
+        }
+
+config_cache = ConfigCache(CONFIG_CACHE_TTL)
+
 # ───────────────── Codes instead of timed links ───────────────── #
-def load_codes():
-    config = config_collection.find_one({"_id": "codes"}) or {}
-    return config.get("codes", [])
+# Redeem codes are a pool like the Gmail ones (pool_items, pool="codes").
+async def save_codes(codes: list):
+    return await _save_pool(CODES_POOL, codes)
 
-def save_codes(codes: list):
-    config_collection.update_one({"_id": "codes"}, {"$set": {"codes": codes}}, upsert=True)
+async def count_codes() -> int:
+    """ Number of redeem codes left (cached). """
+    return await pool_size(CODES_POOL)
 
-def get_current_code():
-    codes = load_codes()
-    if not codes:
-        return None  # no codes left
-    code = codes.pop(0)  # take first
-    save_codes(codes)
-    return code
+async def get_current_code():
+    return await code_lease.take()  # None when no codes left
 
 # ───────────────── Server-specific Gmail pool helpers ───────────────── #
-def _load_pool(key: str):
-    cfg = config_collection.find_one({"_id": key}) or {}
-    return cfg.get("list", [])
-
-def _save_pool(key: str, list_of_emails):
-    config_collection.update_one({"_id": key}, {"$set": {"list": list_of_emails}}, upsert=True)
+# Every pool entry is its own document: {pool, value, status, added_at}.
+# Dispensing claims the oldest "available" entry with one atomic
+# find_one_and_update, so it costs a single indexed round trip no matter how
+# big the pool is, and two concurrent claims can never get the same entry.
+POOL_AVAILABLE = "available"
+POOL_DISPENSED = "dispensed"
+POOL_LEASED = "leased"  # redeem codes held by one process (see CodeLease)
+POOL_STAGED = "staged"  # a replace upload not swapped in yet (see ingest_document)
+POOL_IN_STOCK = {"$in": [POOL_AVAILABLE, POOL_LEASED]}
+
+def _insert_pool_values_sync(key: str, values) -> tuple:
+    """ Insert values in order; (pool, value) is unique in stock, so repeats are skipped. Returns (inserted, duplicates). """
+    if not values:
+        return 0, 0
+    now = datetime.utcnow()
+    try:
+        result = pool_items_collection.insert_many(
+            [{"pool": key, "value": v, "status": POOL_AVAILABLE, "added_at": now} for v in values],
+            ordered=False
+        )
+        return len(result.inserted_ids), 0
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        inserted = e.details.get("nInserted", 0)
+        return inserted, len(values) - inserted
+
+def _save_pool_sync(key: str, list_of_emails):
+    # Leased codes are still stock: a replace must drop them too (their
+    # holders then find the _id gone and skip it, like a reclaimed lease).
+    pool_items_collection.delete_many({"pool": key, "status": POOL_IN_STOCK})
+    return _insert_pool_values_sync(key, list_of_emails)
+
+async def _save_pool(key: str, list_of_emails):
+    """ Replace the in-stock (available or leased) entries of a pool with the given list (kept in order). """
+    inserted, _ = await run_db(_save_pool_sync, key, list_of_emails)
+    config_cache.invalidate(f"pool_size:{key}")
+    return inserted
+
+async def pool_size(key: str) -> int:
+    """ Number of available entries in a pool (cached). """
+    return await config_cache.get(
+        f"pool_size:{key}",
+        lambda: run_db(pool_items_collection.count_documents, {"pool": key, "status": POOL_IN_STOCK})
+    )
 
-def pop_from_pool(key: str):
-    """ Pop and return the first email from stored list. Returns None if empty. """
-    lst = _load_pool(key)
-    if not lst:
+async def pop_from_pool(key: str):
+    """ Atomically claim and return the oldest email of a pool. Returns None if empty. """
+    doc = await run_db(
+        pool_items_collection.find_one_and_update,
+        {"pool": key, "status": POOL_AVAILABLE},
+        {"$set": {"status": POOL_DISPENSED, "dispensed_at": datetime.utcnow()}},
+        sort=[("_id", ASCENDING)],
+        projection={"value": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if doc is None and await run_db(_drain_legacy_pool_sync, key):
+        return await pop_from_pool(key)
+    if doc is None:
         return None
-    email = lst.pop(0)
-    _save_pool(key, lst)
-    return email
+    config_cache.adjust(f"pool_size:{key}", -1)  # not a recount per dispense
+    return doc["value"]
+
+def _drain_legacy_pool_sync(key: str) -> bool:
+    """
+    Move a leftover config array of this pool into pool_items. Migrations 1
+    and 2 do this in the background after startup; this catches entries read
+    before they got there, or written by an older process during a rolling
+    deploy.
+    """
+    doc_id, field = LEGACY_POOL_ARRAYS.get(key, (key, "list"))
+    if config_collection.find_one({"_id": doc_id, f"{field}.0": {"$exists": True}}, {"_id": 1}) is None:
+        return False
+    _migrate_config_array(doc_id, field, key)
+    return True
 
 # keys we'll use
 POOL_INDIA = "gmails_india"
 POOL_SGP = "gmails_singapore"
+CODES_POOL = "codes"
+# pool -> (config _id, array field) of its pre-pool_items storage
+LEGACY_POOL_ARRAYS = {CODES_POOL: ("codes", "codes")}
+
+# ───────────────── Leased redeem-code batches ───────────────── #
+# Each process leases CODE_LEASE_BATCH codes at a time (status "leased" with
+# its lease_id and lease_expires) and serves redemptions from that local
+# batch, so workers stop contending on the head of the same pool. Handing a
+# code out is an update conditional on (_id, lease_id, leased): a code whose
+# lease lapsed and was reclaimed elsewhere is skipped, never given twice.
+# Leases are renewed while held, become reclaimable when a process dies
+# without renewing, and are released on clean shutdown.
+CODE_LEASE_BATCH = int(os.getenv("CODE_LEASE_BATCH", "20"))
+CODE_LEASE_LOW = int(os.getenv("CODE_LEASE_LOW", "5"))  # refill in the background below this
+CODE_LEASE_TTL = float(os.getenv("CODE_LEASE_TTL", "300"))
+CODE_LEASE_LOST = Counter("bot_code_lease_lost_total", "Leased codes skipped because the lease had been reclaimed")
+
+class CodeLease:
+    def __init__(self, pool: str, batch: int, low: int, ttl: float):
+        self.pool = pool
+        self.batch = batch
+        self.low = low
+        self.ttl = ttl
+        self.lease_id = f"{os.getpid()}:{secrets.token_hex(6)}"
+        self._codes = collections.deque()  # (_id, value) leased to this process
+        self._lock = asyncio.Lock()  # one lease (three Mongo calls) at a time
+        self._refill = BackgroundTask(self._fill)
+        self._renewer = BackgroundTask(self._renew)
+
+    def _lease_sync(self, n: int) -> list:
+        """ find candidates -> update_many the ones still claimable -> read back what we actually got. """
+        now = datetime.utcnow()
+        claimable = {"pool": self.pool, "$or": [
+            {"status": POOL_AVAILABLE},
+            {"status": POOL_LEASED, "lease_expires": {"$lt": now}},
+        ]}
+        ids = [d["_id"] for d in pool_items_collection.find(claimable, {"_id": 1}).sort("_id", ASCENDING).limit(n)]
+        if not ids:
+            return []
+        pool_items_collection.update_many(
+            {"_id": {"$in": ids}, **claimable},
+            {"$set": {"status": POOL_LEASED, "lease_id": self.lease_id,
+                      "lease_expires": now + timedelta(seconds=self.ttl)}}
+        )
+        leased = pool_items_collection.find(
+            {"_id": {"$in": ids}, "lease_id": self.lease_id, "status": POOL_LEASED}, {"value": 1}
+        ).sort("_id", ASCENDING)
+        return [(d["_id"], d["value"]) for d in leased]
+
+    def _dispense_sync(self, item_id) -> bool:
+        result = pool_items_collection.update_one(
+            {"_id": item_id, "lease_id": self.lease_id, "status": POOL_LEASED},
+            {"$set": {"status": POOL_DISPENSED, "dispensed_at": datetime.utcnow()},
+             "$unset": {"lease_id": "", "lease_expires": ""}}
+        )
+        return result.modified_count == 1
+
+    async def _fill(self):
+        async with self._lock:
+            if len(self._codes) >= self.low:
+                return
+            leased = await run_db(self._lease_sync, self.batch)
+            if not leased and await run_db(_drain_legacy_pool_sync, self.pool):
+                leased = await run_db(self._lease_sync, self.batch)
+            self._codes.extend(leased)
+
+    async def take(self):
+        """ Next code from the local lease, leasing more when low. None when the pool is empty. """
+        while True:
+            if not self._codes:
+                await self._fill()
+                if not self._codes:
+                    return None
+            item_id, value = self._codes.popleft()
+            if len(self._codes) < self.low:
+                self._refill.start()
+            if await run_db(self._dispense_sync, item_id):
+                config_cache.adjust(f"pool_size:{self.pool}", -1)
+                return value
+            CODE_LEASE_LOST.inc()
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if not self._codes:
+                continue
+            try:
+                await run_db(
+                    pool_items_collection.update_many,
+                    {"lease_id": self.lease_id, "status": POOL_LEASED},
+                    {"$set": {"lease_expires": datetime.utcnow() + timedelta(seconds=self.ttl)}}
+                )
+            except Exception as e:
+                log.warning("code lease renewal failed: %s", e)
+
+    def start(self):
+        self._renewer.start()
+
+    async def stop(self):
+        """ Return every code still leased to this process to the pool. """
+        await self._renewer.stop()
+        await self._refill.stop()
+        self._codes.clear()
+        await run_db(
+            pool_items_collection.update_many,
+            {"lease_id": self.lease_id, "status": POOL_LEASED},
+            {"$set": {"status": POOL_AVAILABLE}, "$unset": {"lease_id": "", "lease_expires": ""}}
+        )
+
+code_lease = CodeLease(CODES_POOL, CODE_LEASE_BATCH, CODE_LEASE_LOW, CODE_LEASE_TTL)
+
+# ───────────────── Server / region registry ───────────────── #
+# Regions live in the `regions` collection ({_id, label, pool, order, enabled})
+# and are cached; the server menu, dispensing and stock reports read them, so
+# adding a region is a /region add away. Ids stay short enough for signed
+# tokens and callback_data.
+REGION_ID_RE = re.compile(r"^[a-z0-9_]{1,10}$")
+DEFAULT_REGIONS = [
+    {"_id": "india", "label": "India", "pool": POOL_INDIA, "order": 1},
+    {"_id": "singapore", "label": "Singapore", "pool": POOL_SGP, "order": 2},
+]
+
+def _load_regions_sync():
+    return list(regions_collection.find({"enabled": True}).sort([("order", ASCENDING), ("_id", ASCENDING)]))
+
+async def get_regions() -> list:
+    return await config_cache.get("regions", lambda: run_db(_load_regions_sync))
+
+async def get_region(region_id: str):
+    region_id = (region_id or "").lower()
+    return next((r for r in await get_regions() if r["_id"] == region_id), None)
+
+async def resolve_pool(target: str):
+    """ "codes" or a region id -> (pool key, label); None if unknown. """
+    if target.lower() == "codes":
+        return CODES_POOL, "Redeem codes"
+    region = await get_region(target)
+    return (region["pool"], f"{region['label']} Gmail pool") if region else None
+
+async def pool_label(key: str) -> str:
+    if key == CODES_POOL:
+        return "Redeem codes"
+    region = next((r for r in await get_regions() if r["pool"] == key), None)
+    return f"{region['label']} Gmail pool" if region else key
+
+def _stock_sync() -> dict:
+    """ Undispensed entries per pool in a single aggregation. """
+    rows = pool_items_collection.aggregate([
+        {"$match": {"status": POOL_IN_STOCK}},
+        {"$group": {"_id": "$pool", "n": {"$sum": 1}}}
+    ])
+    return {row["_id"]: row["n"] for row in rows}
+
+# ───────────────── Bulk ingestion from uploaded files ───────────────── #
+# Admins can send a .txt/.csv document with /ingmail, /sigmail or /time as the
+# caption (optionally followed by "append" or "replace"). The file is streamed
+# chunk by chunk, validated, and inserted in INGEST_BATCH batches, so memory
+# stays bounded whatever the file size. Append de-duplicates against the
+# stock through the unique in-stock (pool, value) index; a value dispensed
+# earlier can be stocked again. Replace writes the file as "staged" entries
+# under one batch id and only swaps them for the old stock once the whole
+# file is in, so a failed upload leaves the pool as it was.
+INGEST_BATCH = int(os.getenv("INGEST_BATCH", "1000"))
+INGEST_PROGRESS_EVERY = float(os.getenv("INGEST_PROGRESS_EVERY", "5"))
+INGEST_STAGED_TTL = int(os.getenv("INGEST_STAGED_TTL", "86400"))  # reaps staged rows of a crashed upload
+EMAIL_RE = re.compile(r"^[^@\s,;]+@[^@\s,;]+\.[^@\s,;]+$")
+CSV_HEADERS = {"email", "gmail", "mail", "code", "codes", "value"}
+
+def valid_email(value: str) -> bool:
+    return bool(EMAIL_RE.match(value))
+
+def valid_code(value: str) -> bool:
+    return 0 < len(value) <= 64 and not any(c.isspace() for c in value)
+
+async def iter_document_lines(bot, message):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in bot.stream_media(message):
+        lines = (tail + decoder.decode(bytes(chunk))).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def _line_values(line: str, is_csv: bool):
+    """ CSV: the first column; text: every whitespace-separated token. """
+    if is_csv:
+        cells = next(csv.reader([line]), [])
+        return [cells[0].strip()] if cells and cells[0].strip() else []
+    return line.split()
+
+def _stage_pool_values_sync(key: str, batch_id, values) -> tuple:
+    now = datetime.utcnow()
+    pool_items_collection.insert_many(
+        [{"pool": key, "value": v, "status": POOL_STAGED, "batch": batch_id, "added_at": now, "staged_at": now}
+         for v in values],
+        ordered=False
+    )
+    return len(values), 0
+
+def _swap_staged_sync(key: str, batch_id) -> int:
+    """ Replace the pool's stock with a staged batch. Returns how many repeats within the batch were dropped. """
+    repeats = pool_items_collection.aggregate([
+        {"$match": {"batch": batch_id}},
+        {"$group": {"_id": "$value", "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    dropped = 0
+    for group in repeats:
+        dropped += pool_items_collection.delete_many({"_id": {"$in": sorted(group["ids"])[1:]}}).deleted_count
+    pool_items_collection.delete_many({"pool": key, "status": POOL_IN_STOCK})
+    pool_items_collection.update_many(
+        {"batch": batch_id},
+        {"$set": {"status": POOL_AVAILABLE}, "$unset": {"batch": "", "staged_at": ""}}
+    )
+    return dropped
+
+async def ingest_document(bot, message, pool_key: str, label: str, validate, args):
+    """ args: the caption words after the command (and region); the first may be append/replace. """
+    mode = args[0].lower() if args else "append"
+    if mode not in ("append", "replace"):
+        return await message.reply("Usage: send a .txt/.csv file with the command as caption, then append or replace.")
+    file_name = message.document.file_name or "upload.txt"
+    is_csv = file_name.lower().endswith(".csv")
+    status = await message.reply(f"📥 Ingesting `{file_name}` into {label} ({mode})...")
+    staged = ObjectId() if mode == "replace" else None
+
+    stats = {"lines": 0, "inserted": 0, "duplicates": 0, "invalid": 0}
+    batch = []
+    last_progress = time.monotonic()
+
+    async def flush():
+        if staged is not None:
+            inserted, duplicates = await run_db(_stage_pool_values_sync, pool_key, staged, batch)
+        else:
+            inserted, duplicates = await run_db(_insert_pool_values_sync, pool_key, batch)
+        stats["inserted"] += inserted
+        stats["duplicates"] += duplicates
+        batch.clear()
+
+    def summary() -> str:
+        return (f"Lines: {stats['lines']}\nAdded: {stats['inserted']}\n"
+                f"Duplicates skipped (already in stock or repeated): {stats['duplicates']}\nInvalid skipped: {stats['invalid']}")
+
+    try:
+        async for line in iter_document_lines(bot, message):
+            stats["lines"] += 1
+            for value in _line_values(line, is_csv):
+                if is_csv and stats["lines"] == 1 and value.lower() in CSV_HEADERS:
+                    continue
+                if not validate(value):
+                    stats["invalid"] += 1
+                    continue
+                batch.append(value)
+            if len(batch) >= INGEST_BATCH:
+                await flush()
+                if time.monotonic() - last_progress >= INGEST_PROGRESS_EVERY:
+                    last_progress = time.monotonic()
+                    await status.edit_text(f"📥 Ingesting `{file_name}` into {label}...\n\n{summary()}")
+        if batch:
+            await flush()
+        if staged is not None:
+            repeats = await run_db(_swap_staged_sync, pool_key, staged)
+            stats["inserted"] -= repeats
+            stats["duplicates"] += repeats
+    except BaseException as e:
+        if staged is not None:
+            await run_db(pool_items_collection.delete_many, {"batch": staged})
+        if not isinstance(e, Exception):
+            raise
+        log.exception("ingestion of %s failed", file_name)
+        note = "The pool was left unchanged." if staged is not None else "Entries added before the error were kept."
+        return await status.edit_text(f"❌ Ingestion stopped: {e}\n{note}\n\n{summary()}")
+    finally:
+        config_cache.invalidate(f"pool_size:{pool_key}")
+    total = await pool_size(pool_key)
+    await status.edit_text(f"✅ {label} updated ({mode}).\n\n{summary()}\n\nAvailable now: {total}")
 
 # ───────────────── Admin Key Helpers ───────────────── #
-def get_current_admin_key():
+async def get_current_admin_key():
     """ Retrieves the current active admin key. """
-    key_data = config_collection.find_one({"_id": ADMIN_KEY_CONFIG_ID})
+    key_data = await config_cache.get(
+        ADMIN_KEY_CONFIG_ID,
+        lambda: run_db(config_collection.find_one, {"_id": ADMIN_KEY_CONFIG_ID})
+    )
     if key_data and not key_data.get("expired"):
         return key_data.get("key")
     return None
 
-def generate_new_admin_key() -> str:
+async def generate_new_admin_key() -> str:
     """ Generates a new key, expires the old one, and saves the new one. """
     # 1. Expire the old key (if any)
-    config_collection.update_one(
+    await run_db(
+        config_collection.update_one,
         {"_id": ADMIN_KEY_CONFIG_ID, "expired": {"$ne": True}},
         {"$set": {"expired": True, "expired_by": "Garena Admin"}},
         upsert=False
@@ -101,11 +946,13 @@ def generate_new_admin_key() -> str:
 
     # 2. Generate and save the new key
     new_key = gen_token(10)  # 10 chars for the admin key
-    config_collection.update_one(
+    await run_db(
+        config_collection.update_one,
         {"_id": ADMIN_KEY_CONFIG_ID},
         {"$set": {"key": new_key, "expired": False, "created_at": datetime.utcnow()}},
         upsert=True
     )
+    config_cache.invalidate(ADMIN_KEY_CONFIG_ID)
     return new_key
 
 # ───────────────── Helpers ───────────────── #
@@ -113,28 +960,540 @@ def gen_token(n: int = 16) -> str:
     alphabet = string.ascii_letters + string.digits
     return ''.join(random.choices(alphabet, k=n))
 
-async def shorten_with_arolinks(long_url: str) -> str:
-    encoded_url = urllib.parse.quote_plus(long_url)
-    api_url = f"https://arolinks.com/api?api={AROLINKS_API}&url={encoded_url}&format=text"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(api_url, timeout=20) as resp:
+# ───────────────── Link shortener client ───────────────── #
+class CircuitBreaker:
+    """ Opens after N consecutive failures; lets one trial call through after the cooldown. """
+
+    def __init__(self, max_failures: int, cooldown: float):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_cancelled(self):
+        # A cancelled call (deadline, hedged loser) proves nothing either way;
+        # just free the half-open slot so the next call can probe.
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_running = False
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+
+class ShortenerProvider:
+    def __init__(self, name: str, url_template: str):
+        self.name = name
+        self.url_template = url_template
+        self.breaker = CircuitBreaker(SHORTENER_BREAKER_FAILURES, SHORTENER_BREAKER_COOLDOWN)
+        self.latency = 0.0  # EWMA in seconds; 0 until the first success so new backends get tried
+
+    def api_url(self, long_url: str) -> str:
+        return self.url_template.format(url=urllib.parse.quote_plus(long_url))
+
+    def observe_latency(self, seconds: float):
+        self.latency = seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+
+class ShortenerClient:
+    """
+    Long-lived shortener client: one pooled aiohttp session, tight connect/read
+    deadlines and a circuit breaker per provider. shorten() returns "" when no
+    provider could produce a link, so callers fall back to the raw deep link.
+    """
+
+    def __init__(self, providers, routing: str = "latency"):
+        self.providers = providers
+        self.routing = routing
+        self._session = None
+
+    @classmethod
+    def from_env(cls, spec: str, routing: str):
+        providers = []
+        for entry in spec.split(","):
+            if "|" not in entry:
+                continue
+            name, template = entry.split("|", 1)
+            providers.append(ShortenerProvider(name.strip(), template.strip()))
+        return cls(providers, routing)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=SHORTENER_POOL_SIZE, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=SHORTENER_CONNECT_TIMEOUT,
+                    sock_read=SHORTENER_READ_TIMEOUT
+                )
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _call(self, provider: ShortenerProvider, long_url: str) -> str:
+        if not provider.breaker.allow():
+            return ""
+        started = time.monotonic()
+        try:
+            async with self._get_session().get(provider.api_url(long_url)) as resp:
+                resp.raise_for_status()
                 text = (await resp.text()).strip()
-                if text.startswith("http"):
-                    return text
-                return ""  # failed
-    except Exception:
+            if not text.startswith("http"):
+                raise ValueError(f"unexpected response {text[:80]!r}")
+        except asyncio.CancelledError:
+            provider.breaker.record_cancelled()
+            raise
+        except Exception as e:
+            provider.breaker.record_failure()
+            SHORTENER_SECONDS.observe(time.monotonic() - started, provider.name, "error")
+            log.warning("shortener %s failed (%s): %s", provider.name, provider.breaker.state, e)
+            return ""
+        provider.breaker.record_success()
+        provider.observe_latency(time.monotonic() - started)
+        SHORTENER_SECONDS.observe(time.monotonic() - started, provider.name, "ok")
+        return text
+
+    async def _sequential(self, candidates, long_url: str) -> str:
+        for provider in candidates:
+            short = await self._call(provider, long_url)
+            if short:
+                return short
         return ""
 
-async def build_verify_link(bot: Client, token: str) -> str:
-    me = await bot.get_me()
-    deep_link = f"https://t.me/{me.username}?start=GL{token}"
-    short = await shorten_with_arolinks(deep_link)
+    async def _hedged(self, candidates, long_url: str) -> str:
+        """ Start the fastest provider, and add the next one every SHORTENER_HEDGE_DELAY until one answers. """
+        remaining = list(candidates)
+        pending = set()
+        try:
+            while remaining or pending:
+                if remaining:
+                    pending.add(asyncio.create_task(self._call(remaining.pop(0), long_url)))
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=SHORTENER_HEDGE_DELAY if remaining else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.result():
+                        return task.result()
+            return ""
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def shorten(self, long_url: str) -> str:
+        candidates = sorted(
+            (p for p in self.providers if p.breaker.state != "open"),
+            key=lambda p: p.latency
+        )
+        if not candidates:
+            return ""
+        route = self._hedged if self.routing == "hedged" else self._sequential
+        try:
+            return await asyncio.wait_for(route(candidates, long_url), SHORTENER_DEADLINE)
+        except asyncio.TimeoutError:
+            log.warning("shortener deadline of %.1fs exceeded", SHORTENER_DEADLINE)
+            return ""
+
+shortener = ShortenerClient.from_env(SHORTENER_PROVIDERS, SHORTENER_ROUTING)
+
+# Resolved once in main() after the client starts, instead of get_me() per link.
+BOT_USERNAME = None
+
+def verify_deep_link(token: str) -> str:
+    return f"https://t.me/{BOT_USERNAME}?start=GL{token}"
+
+async def build_verify_link(token: str) -> str:
+    deep_link = verify_deep_link(token)
+    short = await shortener.shorten(deep_link)
     return short or deep_link
 
-def ensure_user(user_id: int):
-    if not users_collection.find_one({"_id": user_id}):
-        users_collection.insert_one({"_id": user_id})
+# ───────────────── User registration ───────────────── #
+USER_FLUSH_SIZE = int(os.getenv("USER_FLUSH_SIZE", "500"))
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "2"))
+
+class SeenUsers:
+    """
+    Exact set of known user ids. Ids loaded at startup live in a sorted
+    array('q') searched with bisect: 8 bytes per user, so one million users
+    cost ~8 MB (a Python set of the same ints is ~60 MB). Ids seen since then
+    sit in a small set that is merged into the array once it reaches merge_at.
+    """
+
+    def __init__(self, merge_at: int = 10000):
+        self.merge_at = merge_at
+        self._sorted = array("q")
+        self._recent = set()
+
+    def _in_sorted(self, user_id: int) -> bool:
+        i = bisect.bisect_left(self._sorted, user_id)
+        return i < len(self._sorted) and self._sorted[i] == user_id
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._recent or self._in_sorted(user_id)
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, user_id: int):
+        if user_id in self:
+            return
+        self._recent.add(user_id)
+        if len(self._recent) >= self.merge_at:
+            self._merge()
+
+    def _merge(self):
+        self._sorted = array("q", heapq.merge(self._sorted, sorted(self._recent)))
+        self._recent = set()
+
+    def load(self, sorted_ids: array):
+        """ Replace the preloaded part with ids already sorted ascending; keeps anything added meanwhile. """
+        self._sorted = sorted_ids
+        self._recent = {uid for uid in self._recent if not self._in_sorted(uid)}
+
+    def nbytes(self) -> int:
+        return len(self._sorted) * self._sorted.itemsize + sys.getsizeof(self._recent)
+
+seen_users = SeenUsers()
+
+def _load_user_ids_sync() -> array:
+    ids = array("q")
+    for doc in users_collection.find({}, {"_id": 1}).sort("_id", ASCENDING).batch_size(10000):
+        ids.append(doc["_id"])
+    return ids
+
+async def preload_seen_users():
+    started = time.monotonic()
+    seen_users.load(await run_db(_load_user_ids_sync))
+    log.info("preloaded %d users in %.1fs (%.1f MB)", len(seen_users), time.monotonic() - started, seen_users.nbytes() / 1e6)
+
+class UserWriter:
+    """ Buffers new user ids and upserts them in one bulk_write per USER_FLUSH_SIZE ids or USER_FLUSH_INTERVAL. """
+
+    def __init__(self, flush_size: int, interval: float):
+        self.flush_size = flush_size
+        self.interval = interval
+        self._pending = {}  # user_id -> first seen
+        self._full = asyncio.Event()
+        self._runner = BackgroundTask(self._run)
+
+    def add(self, user_id: int):
+        self._pending.setdefault(user_id, datetime.utcnow())
+        if len(self._pending) >= self.flush_size:
+            self._full.set()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        ops = [UpdateOne({"_id": uid}, {"$setOnInsert": {"joined_at": at}}, upsert=True) for uid, at in batch.items()]
+        try:
+            await run_db(users_collection.bulk_write, ops, ordered=False)
+        except Exception as e:
+            log.warning("user flush of %d ids failed, will retry: %s", len(batch), e)
+            for uid, at in batch.items():
+                self._pending.setdefault(uid, at)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def start(self):
+        self._runner.start()
+
+    async def stop(self):
+        await self._runner.stop()
+        await self.flush()
+
+user_writer = UserWriter(USER_FLUSH_SIZE, USER_FLUSH_INTERVAL)
+
+async def ensure_user(user_id: int):
+    """ Known users cost nothing; new ones are written behind by user_writer. """
+    if user_id in seen_users:
+        return
+    seen_users.add(user_id)
+    user_writer.add(user_id)
+
+# ───────────────── Verification token storage ───────────────── #
+TOKEN_PURPOSES = ("show_account", "access_gmail", "redeem")
+
+async def create_token(token: str, user_id: int, purpose: str, server: str = None):
+    doc = {
+        "_id": token,
+        "user_id": user_id,
+        "used": False,
+        "purpose": purpose,
+        "created_at": datetime.utcnow()
+    }
+    if server is not None:
+        doc["server"] = server
+    await run_db(tokens_collection.insert_one, doc)
+
+TOKEN_FIELDS = {"user_id": 1, "used": 1, "purpose": 1, "server": 1}
+
+async def get_token(token: str):
+    if len(token) > DB_TOKEN_LENGTH:
+        return verify_signed_token(token)
+    return await run_db(tokens_collection.find_one, {"_id": token}, TOKEN_FIELDS)
+
+async def redeem_token(token: str, user_id: int):
+    """
+    Atomically claims a token for user_id. Returns (tok, None) on success, where
+    tok is the pre-image (purpose/server), or (tok_or_None, reason) with reason
+    one of "missing", "foreign", "used". Only one of many concurrent calls wins.
+    """
+    if len(token) > DB_TOKEN_LENGTH:
+        tok = verify_signed_token(token)
+        if not tok:
+            return None, "missing"
+        if tok["user_id"] != user_id:
+            return tok, "foreign"
+        if tok["used"] or not await claim_signed_token(tok):
+            return tok, "used"
+        return tok, None
+
+    tok = await run_db(
+        tokens_collection.find_one_and_update,
+        {"_id": token, "user_id": user_id, "used": False},
+        {"$set": {"used": True, "used_at": datetime.utcnow()}},
+        projection=TOKEN_FIELDS,
+        return_document=ReturnDocument.BEFORE
+    )
+    if tok:
+        return tok, None
+    # Lost the claim: one more read (failure path only) to pick the right reply.
+    tok = await get_token(token)
+    if not tok:
+        return None, "missing"
+    if tok.get("user_id") != user_id:
+        return tok, "foreign"
+    return tok, "used"
+
+# ───────────────── Signed (stateless) tokens ───────────────── #
+# TOKEN_MODE=signed replaces the tokens document with an HMAC-signed payload:
+#   purpose(1) | user_id(8) | expires(4) | nonce(4) | len(1) | server(<=10) | mac(8)
+# which is at most 36 bytes -> 48 base64url chars, so both "GL<token>" and
+# "final_verify:<token>" stay under Telegram's 64-byte limits. Validation is
+# pure CPU; single use is enforced by inserting the mac into `used_tokens`
+# (TTL-expired) with a small in-process set in front to reject double taps.
+TOKEN_MODE = os.getenv("TOKEN_MODE", "db")  # "db" or "signed"
+TOKEN_SECRET = (os.getenv("TOKEN_SECRET") or hashlib.sha256(os.environ["BOT_TOKEN"].encode()).hexdigest()).encode()
+SIGNED_TOKEN_TTL = int(os.getenv("SIGNED_TOKEN_TTL", "86400"))
+SIGNED_SERVER_MAX = 10
+SIGNED_MAC_BYTES = 8
+DB_TOKEN_LENGTH = 16  # gen_token() default; anything longer is a signed token
+
+class ExpiringSet:
+    def __init__(self, purge_every: int = 1000):
+        self._items = {}  # key -> expiry (epoch seconds)
+        self._purge_every = purge_every
+        self._adds = 0
+
+    def add(self, key, expires_at: float):
+        self._items[key] = expires_at
+        self._adds += 1
+        if self._adds % self._purge_every == 0:
+            now = time.time()
+            for k in [k for k, exp in self._items.items() if exp <= now]:
+                del self._items[k]
+
+    def discard(self, key):
+        self._items.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        expires_at = self._items.get(key)
+        return expires_at is not None and expires_at > time.time()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+recently_used_tokens = ExpiringSet()
+
+def _token_mac(body: bytes) -> bytes:
+    return hmac.new(TOKEN_SECRET, body, hashlib.sha256).digest()[:SIGNED_MAC_BYTES]
+
+def sign_token(user_id: int, purpose: str, server: str = None) -> str:
+    server_bytes = (server or "").encode()
+    if len(server_bytes) > SIGNED_SERVER_MAX:
+        raise ValueError(f"server name too long for a signed token: {server!r}")
+    body = struct.pack(
+        ">BQII",
+        TOKEN_PURPOSES.index(purpose),
+        user_id,
+        int(time.time()) + SIGNED_TOKEN_TTL,
+        secrets.randbits(32)
+    ) + bytes([len(server_bytes)]) + server_bytes
+    return base64.urlsafe_b64encode(body + _token_mac(body)).rstrip(b"=").decode()
+
+def verify_signed_token(token: str):
+    """ Returns a token dict shaped like a tokens document, or None if forged/expired. """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        body, mac = raw[:-SIGNED_MAC_BYTES], raw[-SIGNED_MAC_BYTES:]
+        if not hmac.compare_digest(mac, _token_mac(body)):
+            return None
+        purpose_idx, user_id, expires, _nonce = struct.unpack(">BQII", body[:17])
+        server = body[18:18 + body[17]].decode() or None
+        purpose = TOKEN_PURPOSES[purpose_idx]
+    except (ValueError, IndexError, struct.error):
+        return None
+    if expires < time.time():
+        return None
+    return {
+        "_id": token,
+        "user_id": user_id,
+        "purpose": purpose,
+        "server": server,
+        "expires_at": expires,
+        "used": mac.hex() in recently_used_tokens,
+        "mac": mac.hex(),
+        "signed": True,
+    }
+
+async def claim_signed_token(tok: dict) -> bool:
+    key = tok["mac"]
+    if key in recently_used_tokens:
+        return False
+    # Marked before the insert so a second tap in this process stops here,
+    # but unmarked if the insert fails: the token was never actually used.
+    recently_used_tokens.add(key, tok["expires_at"])
+    try:
+        await run_db(used_tokens_collection.insert_one, {
+            "_id": key,
+            "expires_at": datetime.utcfromtimestamp(tok["expires_at"])
+        })
+    except DuplicateKeyError:
+        return False
+    except BaseException:
+        recently_used_tokens.discard(key)
+        raise
+    return True
+
+async def bind_token(token: str, user_id: int, server: str = None) -> bool:
+    """ Attach a pre-built (unowned) token to a user. False if it is gone or already taken. """
+    fields = {"user_id": user_id, "created_at": datetime.utcnow()}
+    if server is not None:
+        fields["server"] = server
+    result = await run_db(tokens_collection.update_one, {"_id": token, "user_id": None}, {"$set": fields})
+    return result.modified_count == 1
+
+async def fetch_user_id_batch(after_id, limit: int):
+    """ Next `limit` user ids greater than after_id, in _id order (projection-only). """
+    query = {"_id": {"$gt": after_id}} if after_id is not None else {}
+    return await run_db(
+        lambda: [u["_id"] for u in users_collection.find(query, {"_id": 1}).sort("_id", ASCENDING).limit(limit)]
+    )
+
+# ───────────────── Pre-warmed verification links ───────────────── #
+TOKEN_RESERVE_LOW = int(os.getenv("TOKEN_RESERVE_LOW", "20"))
+TOKEN_RESERVE_HIGH = int(os.getenv("TOKEN_RESERVE_HIGH", "100"))  # 0 disables the reserve
+TOKEN_RESERVE_CONCURRENCY = int(os.getenv("TOKEN_RESERVE_CONCURRENCY", "5"))
+TOKEN_RESERVE_RETRY = float(os.getenv("TOKEN_RESERVE_RETRY", "10"))  # seconds after a failed refill
+
+class TokenReserve:
+    """
+    Keeps a per-purpose stock of ready (token, short URL) pairs. The tokens are
+    stored without an owner; a click only binds one to the user, so the token
+    insert and the shortener call happen off the click path. The producer
+    refills up to `high` whenever a purpose drops below `low`, and retries
+    after TOKEN_RESERVE_RETRY when a refill fails. Only shortened links are
+    stocked: the raw deep link fallback belongs to the live click path.
+    """
+
+    def __init__(self, purposes, low: int, high: int):
+        self.low = low
+        self.high = high
+        self.stock = {purpose: collections.deque() for purpose in purposes}
+        self._wakeup = asyncio.Event()
+        self._runner = BackgroundTask(self._run)
+
+    def take(self, purpose: str):
+        stock = self.stock.get(purpose)
+        item = stock.popleft() if stock else None
+        if stock is not None and len(stock) < self.low:
+            self._wakeup.set()
+        return item
+
+    async def _produce_one(self, purpose: str):
+        token = gen_token()
+        url = await shortener.shorten(verify_deep_link(token))
+        if not url:
+            raise RuntimeError("shortener unavailable")
+        await create_token(token, None, purpose)
+        self.stock[purpose].append((token, url))
+
+    async def _fill(self, purpose: str) -> bool:
+        stock = self.stock[purpose]
+        while len(stock) < self.high:
+            batch = min(self.high - len(stock), TOKEN_RESERVE_CONCURRENCY)
+            results = await asyncio.gather(*(self._produce_one(purpose) for _ in range(batch)), return_exceptions=True)
+            errors = [r for r in results if isinstance(r, Exception)]
+            if errors:
+                log.warning("token reserve refill for %s failed: %s", purpose, errors[0])
+                return False
+        return True
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            filled = [await self._fill(purpose) for purpose in self.stock]
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if all(filled) else TOKEN_RESERVE_RETRY)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.high > 0:
+            self._runner.start()
+
+    async def stop(self):
+        await self._runner.stop()
+
+# Signed tokens are owner-specific by construction, so there is nothing to pre-build.
+token_reserve = TokenReserve(TOKEN_PURPOSES, TOKEN_RESERVE_LOW, 0 if TOKEN_MODE == "signed" else TOKEN_RESERVE_HIGH)
+
+async def issue_verify_link(user_id: int, purpose: str, server: str = None) -> str:
+    """ Returns a verification URL owned by user_id, from the reserve when it has stock. """
+    if TOKEN_MODE == "signed" and len((server or "").encode()) <= SIGNED_SERVER_MAX:
+        return await build_verify_link(sign_token(user_id, purpose, server))
+    item = token_reserve.take(purpose)
+    if item is not None:
+        token, url = item
+        if await bind_token(token, user_id, server):
+            return url
+    token = gen_token()
+    await create_token(token, user_id, purpose, server)
+    return await build_verify_link(token)
 
 # ───────────────── Helpers for FF accounts simulation ───────────────── #
 def gen_random_password():
@@ -148,187 +1507,743 @@ def gen_random_level():
 def gen_random_last_login_year():
     return random.randint(2000, 2023)
 
-# ───────────────── Handlers ───────────────── #
+# ───────────────── Per-user throttling ───────────────── #
+# Token bucket per (user, action) in front of the callbacks that cost a Mongo
+# write and a shortener call. Rules are "action=capacity/refill_per_second".
+# A refill of 0 is a fixed quota; both backends reset it once the bucket has
+# sat idle for THROTTLE_QUOTA_TTL. Over-limit taps only get a query.answer.
+# THROTTLE_BACKEND=mongo shares the buckets between workers (one atomic
+# pipeline update per tap).
+THROTTLE_BACKEND = os.getenv("THROTTLE_BACKEND", "memory")  # "memory" or "mongo"
+THROTTLE_RULES = os.getenv("THROTTLE_RULES", "show_account=5/0.1,gen_code=5/0.1,access_gmail=5/0.1")
+THROTTLE_MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", "100000"))
+THROTTLE_QUOTA_TTL = float(os.getenv("THROTTLE_QUOTA_TTL", "86400"))
+THROTTLE_ALLOWED = Counter("bot_throttle_allowed_total", "Taps let through by the limiter", ("action",))
+THROTTLE_LIMITED = Counter("bot_throttle_limited_total", "Taps rejected by the limiter", ("action",))
+
+def parse_throttle_rules(spec: str) -> dict:
+    rules = {}
+    for entry in spec.split(","):
+        if "=" not in entry:
+            continue
+        action, limits = entry.split("=", 1)
+        capacity, rate = limits.split("/", 1)
+        if float(rate) < 0:
+            raise ValueError(f"negative refill rate in throttle rule {entry!r}")
+        rules[action.strip()] = (float(capacity), float(rate))
+    return rules
+
+class MemoryThrottle:
+    """ Buckets are [tokens, updated] lists in an LRU-bounded OrderedDict; idle users fall off the end. """
+
+    def __init__(self, rules: dict, max_keys: int):
+        self.rules = rules
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+
+    async def allow(self, user_id: int, action: str) -> bool:
+        capacity, rate = self.rules[action]
+        key = (user_id, action)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            if rate == 0 and now - bucket[1] >= THROTTLE_QUOTA_TTL:
+                bucket[0] = capacity  # same expiry as the Mongo document
+            else:
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+class MongoThrottle:
+    """ One document per (user, action), refilled and debited in a single pipeline update. """
+
+    def __init__(self, rules: dict):
+        self.rules = rules
+
+    async def allow(self, user_id: int, action: str) -> bool:
+        capacity, rate = self.rules[action]
+        now = datetime.utcnow()
+        # Keep the bucket until it would be full again; a fixed quota never refills.
+        keep = capacity / rate if rate > 0 else THROTTLE_QUOTA_TTL
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, 1000]}
+        doc = await run_db(
+            throttle_collection.find_one_and_update,
+            {"_id": f"{user_id}:{action}"},
+            [
+                {"$set": {"tokens": {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}]}]}}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "updated": now,
+                    "expires_at": now + timedelta(seconds=keep),
+                }},
+            ],
+            upsert=True,
+            projection={"allowed": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return bool(doc and doc.get("allowed"))
+
+throttle_rules = parse_throttle_rules(THROTTLE_RULES)
+throttle = MongoThrottle(throttle_rules) if THROTTLE_BACKEND == "mongo" else MemoryThrottle(throttle_rules, THROTTLE_MAX_KEYS)
+
+def throttled(action: str):
+    """ Callback-query decorator: over-limit taps get a cheap answer instead of running the handler. """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(bot, query):
+            if action in throttle.rules:
+                try:
+                    allowed = await throttle.allow(query.from_user.id, action)
+                except Exception as e:
+                    log.warning("throttle check failed, letting %s through: %s", action, e)
+                    allowed = True
+                if not allowed:
+                    THROTTLE_LIMITED.inc(action)
+                    return await outbox.answer(query, "⏳ Too many taps. Please wait a few seconds and try again.")
+                THROTTLE_ALLOWED.inc(action)
+            return await func(bot, query)
+        return wrapper
+    return decorator
+
+# ───────────────── Outbound scheduler ───────────────── #
+# User-facing send_message / delete / answer calls and broadcast sends all go
+# through `outbox`, one queue per process that keeps the bot under Telegram's
+# limits (~30 calls/sec overall, ~1 message/sec per chat with short bursts).
+# Interactive replies always leave before bulk traffic, and a FloodWait pauses
+# the global bucket and re-queues the call instead of failing the handler.
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "30"))
+if DEPLOY_MODE == "pool":
+    # The receiver (which runs broadcasts) and each handler process get an equal share.
+    OUTBOUND_RATE /= DEPLOY_WORKERS + 1
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "32"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_MAX_CHATS = 100000
+OUTBOUND_STOP_TIMEOUT = float(os.getenv("OUTBOUND_STOP_TIMEOUT", "5"))  # for calls already on the wire
+INTERACTIVE, BULK = 0, 1
+PRIORITY_NAMES = ("interactive", "bulk")
+OUTBOUND_QUEUE_DEPTH = Gauge("bot_outbound_queue_depth", "Telegram calls waiting in the outbound queue", ("priority",))
+OUTBOUND_WAIT_SECONDS = Histogram("bot_outbound_wait_seconds", "Time from enqueue to Telegram call", ("priority",))
+OUTBOUND_FLOOD_WAITS = Counter("bot_outbound_flood_waits_total", "FloodWait errors absorbed by the outbound scheduler")
+
+class AsyncRateLimiter:
+    """ Token bucket shared by every sender of one kind of traffic; pause() honors FloodWait. """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class OutboundCall:
+    __slots__ = ("fn", "args", "kwargs", "chat_id", "priority", "seq", "future", "enqueued", "attempts")
+
+    def __init__(self, fn, args, kwargs, chat_id, priority: int, seq: int, future):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+class OutboundScheduler:
+    """
+    Calls ready to go sit in a heap ordered by (priority, seq); calls whose chat
+    is out of per-chat budget wait in a second heap ordered by due time. A
+    single dispatcher takes a global token per call and runs it as a task.
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, concurrency: int):
+        self.limiter = AsyncRateLimiter(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats = collections.OrderedDict()  # chat_id -> [tokens, updated], LRU-bounded
+        self._ready = []    # (priority, seq, call)
+        self._delayed = []  # (due, seq, call)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._runner = BackgroundTask(self._run)
+        self._sending = set()  # running _send tasks
+
+    def _chat_delay(self, chat_id, now: float) -> float:
+        """ Seconds until chat_id may receive another message; debits its bucket when 0. """
+        if chat_id is None:
+            return 0.0
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = [self.chat_burst, now]
+            if len(self._chats) > OUTBOUND_MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+            bucket[0] = min(self.chat_burst, bucket[0] + (now - bucket[1]) * self.chat_rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.chat_rate
+
+    def _enqueue(self, call: OutboundCall):
+        heapq.heappush(self._ready, (call.priority, call.seq, call))
+        self._wakeup.set()
+
+    async def submit(self, chat_id, priority: int, fn, *args, **kwargs):
+        """ Queues fn(*args, **kwargs) and returns its result once sent. chat_id=None skips the per-chat budget. """
+        self._seq += 1
+        call = OutboundCall(fn, args, kwargs, chat_id, priority, self._seq, asyncio.get_running_loop().create_future())
+        OUTBOUND_QUEUE_DEPTH.inc(PRIORITY_NAMES[priority])
+        self._enqueue(call)
+        return await call.future
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                self._enqueue(heapq.heappop(self._delayed)[2])
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, call = heapq.heappop(self._ready)
+            if call.future.done():  # the caller gave up
+                OUTBOUND_QUEUE_DEPTH.dec(PRIORITY_NAMES[call.priority])
+                continue
+            delay = self._chat_delay(call.chat_id, now)
+            if delay:
+                heapq.heappush(self._delayed, (now + delay, call.seq, call))
+                continue
+            await self._slots.acquire()
+            await self.limiter.acquire()
+            OUTBOUND_QUEUE_DEPTH.dec(PRIORITY_NAMES[call.priority])
+            OUTBOUND_WAIT_SECONDS.observe(time.monotonic() - call.enqueued, PRIORITY_NAMES[call.priority])
+            task = asyncio.create_task(self._send(call))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, call: OutboundCall):
+        try:
+            result = await call.fn(*call.args, **call.kwargs)
+        except FloodWait as e:
+            OUTBOUND_FLOOD_WAITS.inc()
+            log.info("FloodWait on %s: pausing outbound traffic for %ss", call.fn.__name__, e.value)
+            self.limiter.pause(e.value)
+            call.attempts += 1
+            if call.attempts < OUTBOUND_MAX_RETRIES and not call.future.done():
+                OUTBOUND_QUEUE_DEPTH.inc(PRIORITY_NAMES[call.priority])
+                self._enqueue(call)
+            elif not call.future.done():
+                call.future.set_exception(e)
+        except Exception as e:
+            if not call.future.done():
+                call.future.set_exception(e)
+        else:
+            if not call.future.done():
+                call.future.set_result(result)
+        finally:
+            self._slots.release()
+
+    async def send_message(self, bot, chat_id: int, text: str, priority: int = INTERACTIVE, **kwargs):
+        return await self.submit(chat_id, priority, bot.send_message, chat_id, text, **kwargs)
+
+    async def reply(self, message, text: str, priority: int = INTERACTIVE, **kwargs):
+        return await self.submit(message.chat.id, priority, message.reply, text, **kwargs)
+
+    async def answer(self, query, text: str = None, **kwargs):
+        # Answers and deletes post nothing into the chat: global budget only.
+        return await self.submit(None, INTERACTIVE, query.answer, text, **kwargs)
+
+    async def delete(self, message):
+        return await self.submit(None, INTERACTIVE, message.delete)
+
+    def start(self):
+        self._runner.start()
+
+    async def stop(self):
+        await self._runner.stop()
+        # Let calls already sent finish (their callers are waiting), then give up on the rest.
+        if self._sending:
+            _, late = await asyncio.wait(set(self._sending), timeout=OUTBOUND_STOP_TIMEOUT)
+            for task in late:
+                task.cancel()
+
+outbox = OutboundScheduler(OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_CONCURRENCY)
+
+# ───────────────── Force-subscribe membership ───────────────── #
+# Channels live in config `force_sub` as {"chat_id", "url"} entries (cached).
+# Entries without a chat_id (bare invite links) are shown but cannot be
+# checked. Checks for all channels run concurrently; a confirmed membership is
+# remembered per (user, channel) for FORCE_SUB_TTL, so a repeat tap costs no
+# Telegram calls. Any API error or timeout counts as joined (fail open).
+FORCE_SUB_CONFIG_ID = "force_sub"
+FORCE_SUB_TTL = float(os.getenv("FORCE_SUB_TTL", "600"))
+FORCE_SUB_TIMEOUT = float(os.getenv("FORCE_SUB_TIMEOUT", "3"))
+FORCE_SUB_CHECKS = Counter("bot_force_sub_checks_total", "Per-channel membership checks", ("result",))
+JOINED_STATUSES = (ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED)
+
+async def get_force_sub_channels() -> list:
+    doc = await config_cache.get(
+        FORCE_SUB_CONFIG_ID,
+        lambda: run_db(config_collection.find_one, {"_id": FORCE_SUB_CONFIG_ID})
+    )
+    return (doc or {}).get("channels", [])
+
+def force_sub_markup(channels: list) -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton("Subscribe Channel 😎", url=c["url"])] for c in channels]
+    buttons.append([InlineKeyboardButton("Verify ✅", callback_data="verify")])
+    return InlineKeyboardMarkup(buttons)
+
+class MembershipChecker:
+    def __init__(self, ttl: float, timeout: float):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._joined = ExpiringSet()  # (user_id, chat_id) confirmed recently
+
+    async def _is_member(self, bot, chat_id, user_id: int) -> bool:
+        try:
+            member = await asyncio.wait_for(bot.get_chat_member(chat_id, user_id), self.timeout)
+        except UserNotParticipant:
+            FORCE_SUB_CHECKS.inc("missing")
+            return False
+        except Exception as e:
+            FORCE_SUB_CHECKS.inc("error")
+            log.warning("membership check in %s failed, letting user %s through: %r", chat_id, user_id, e)
+            return True
+        if member.status not in JOINED_STATUSES:
+            FORCE_SUB_CHECKS.inc("missing")
+            return False
+        FORCE_SUB_CHECKS.inc("member")
+        self._joined.add((user_id, chat_id), time.time() + self.ttl)
+        return True
+
+    async def missing(self, bot, user_id: int) -> list:
+        """ Channels user_id has not joined; [] when all are joined or cannot be checked. """
+        channels = await get_force_sub_channels()
+        pending = []
+        for channel in channels:
+            if channel.get("chat_id") is None:
+                continue
+            if (user_id, channel["chat_id"]) in self._joined:
+                FORCE_SUB_CHECKS.inc("cached")
+                continue
+            pending.append(channel)
+        if not pending:
+            return []
+        results = await asyncio.gather(*(self._is_member(bot, c["chat_id"], user_id) for c in pending))
+        return [c for c, joined in zip(pending, results) if not joined]
+
+membership = MembershipChecker(FORCE_SUB_TTL, FORCE_SUB_TIMEOUT)
+
+# ───────────────── Funnel analytics ───────────────── #
+# instrumented() records one event per funnel step into a bounded deque (O(1),
+# no awaits); final_verify adds "dispensed"/"stock_out" with the server. A
+# background task drains the deque every ANALYTICS_FLUSH_INTERVAL: raw events
+# go to the `events` time-series collection, and counts plus latency-bucket
+# counters are $inc'ed into `funnel_daily`, which is all /stats reads. When
+# the buffer overflows the oldest events are dropped, never the handler.
+ANALYTICS_BUFFER = int(os.getenv("ANALYTICS_BUFFER", "50000"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "5"))
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "30"))
+FUNNEL_STEPS = {  # handler name -> funnel step
+    "start": "start",
+    "verify_channels": "verify",
+    "joined_handler": "joined",
+    "show_account": "show_account",
+    "generate_code": "gen_code",
+    "final_verify": "final_verify",
+}
+FUNNEL_ORDER = ("start", "verify", "joined", "show_account", "gen_code", "link_return", "final_verify", "dispensed")
+FUNNEL_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+ANALYTICS_DROPPED = Counter("bot_analytics_dropped_total", "Funnel events lost to a full buffer or a failed flush")
+
+def funnel_step(handler: str, update) -> str:
+    # /start GL<token> is the user coming back from the shortener.
+    if handler == "start" and len(getattr(update, "command", None) or []) > 1:
+        return "link_return"
+    return FUNNEL_STEPS[handler]
+
+def _latency_field(seconds: float) -> str:
+    ms = seconds * 1000
+    return "lat.le_" + str(next((b for b in FUNNEL_BUCKETS_MS if ms <= b), "inf"))
+
+class FunnelAnalytics:
+    def __init__(self, size: int, interval: float):
+        self.interval = interval
+        self._buffer = collections.deque(maxlen=size)
+        self._runner = BackgroundTask(self._run)
+
+    def track(self, step: str, user_id: int, seconds: float = None, server: str = None):
+        if len(self._buffer) == self._buffer.maxlen:
+            ANALYTICS_DROPPED.inc()
+        self._buffer.append((datetime.utcnow(), step, server, user_id, seconds))
+
+    @staticmethod
+    def _rollup_ops(batch) -> list:
+        incs = collections.defaultdict(collections.Counter)
+        for ts, step, server, _, seconds in batch:
+            key = (ts.strftime("%Y-%m-%d"), step, server)
+            incs[key]["count"] += 1
+            if seconds is not None:
+                incs[key][_latency_field(seconds)] += 1
+                incs[key]["lat.sum_ms"] += round(seconds * 1000)
+        return [
+            UpdateOne(
+                {"_id": f"{day}:{step}:{server or '-'}"},
+                {"$inc": dict(counts), "$setOnInsert": {"day": day, "step": step, "server": server}},
+                upsert=True
+            )
+            for (day, step, server), counts in incs.items()
+        ]
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch = list(self._buffer)
+        self._buffer.clear()
+        events = [
+            {"ts": ts, "meta": {"step": step, "server": server}, "user_id": user_id,
+             "ms": None if seconds is None else round(seconds * 1000)}
+            for ts, step, server, user_id, seconds in batch
+        ]
+        try:
+            await asyncio.gather(
+                run_db(events_collection.insert_many, events, ordered=False),
+                run_db(funnel_daily_collection.bulk_write, self._rollup_ops(batch), ordered=False)
+            )
+        except Exception as e:
+            # Analytics are best effort: a retry could double-count the rollups.
+            ANALYTICS_DROPPED.inc(amount=len(batch))
+            log.warning("funnel flush of %d events failed: %s", len(batch), e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        self._runner.start()
+
+    async def stop(self):
+        await self._runner.stop()
+        await self.flush()
+
+analytics = FunnelAnalytics(ANALYTICS_BUFFER, ANALYTICS_FLUSH_INTERVAL)
+
+def bucket_percentile(lat: dict, p: float) -> str:
+    """ Upper bound (ms) of the latency bucket holding the p-th percentile. """
+    bounds = [(b, lat.get(f"le_{b}", 0)) for b in FUNNEL_BUCKETS_MS] + [("inf", lat.get("le_inf", 0))]
+    total = sum(n for _, n in bounds)
+    if not total:
+        return "-"
+    seen = 0
+    for bound, n in bounds:
+        seen += n
+        if seen >= p * total:
+            return f"≤{bound}" if bound != "inf" else f">{FUNNEL_BUCKETS_MS[-1]}"
+    return "-"
+
+# ───────────────── Conversation state ───────────────── #
+# Which prompt a user is answering (today only "waiting for admin key").
+# STATE_BACKEND=memory keeps it in this process; STATE_BACKEND=mongo shares it
+# between worker processes and survives restarts. Entries expire either way.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")  # "memory" or "mongo"
+KEY_PROMPT_TTL = int(os.getenv("KEY_PROMPT_TTL", "900"))
+STATE_WAITING_KEY = "waiting_key"
+
+class MemoryStateStore:
+    """ user_id -> (state, expires_at) tuples; expired entries are skipped on read and swept every N writes. """
+
+    def __init__(self, sweep_every: int = 1000):
+        self._entries = {}
+        self._sweep_every = sweep_every
+        self._writes = 0
+
+    def _live(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._entries[user_id]
+            return None
+        return entry[0]
+
+    async def get(self, user_id: int):
+        return self._live(user_id)
+
+    async def set(self, user_id: int, state: str, ttl: float):
+        self._entries[user_id] = (state, time.monotonic() + ttl)
+        self._writes += 1
+        if self._writes % self._sweep_every == 0:
+            now = time.monotonic()
+            for uid in [uid for uid, (_, exp) in self._entries.items() if exp <= now]:
+                del self._entries[uid]
+
+    async def pop(self, user_id: int):
+        state = self._live(user_id)
+        self._entries.pop(user_id, None)
+        return state
+
+    async def delete(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+class MongoStateStore:
+    """ One document per user in conversation_state; the TTL index reaps expired ones. """
+
+    async def get(self, user_id: int):
+        doc = await run_db(
+            conversation_state_collection.find_one,
+            {"_id": user_id, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+        return doc["state"] if doc else None
+
+    async def set(self, user_id: int, state: str, ttl: float):
+        await run_db(
+            conversation_state_collection.update_one,
+            {"_id": user_id},
+            {"$set": {"state": state, "expires_at": datetime.utcnow() + timedelta(seconds=ttl)}},
+            upsert=True
+        )
 
-# A simple dictionary to temporarily store the user's state (waiting for key)
-# A more robust solution would use a database, but for this simple task, in-memory state will work.
-# Key: user_id, Value: True (waiting for key)
-USER_KEY_WAITING_STATE = {}
+    async def pop(self, user_id: int):
+        # Atomic, so two workers receiving the same reply can't both handle it.
+        doc = await run_db(
+            conversation_state_collection.find_one_and_delete,
+            {"_id": user_id, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+        return doc["state"] if doc else None
+
+    async def delete(self, user_id: int):
+        await run_db(conversation_state_collection.delete_one, {"_id": user_id})
 
+conversation_state = MongoStateStore() if STATE_BACKEND == "mongo" else MemoryStateStore()
+
+# ───────────────── Handlers ───────────────── #
 @Bot.on_message(filters.command("start") & filters.private)
+@instrumented("start")
 async def start(bot, message):
     user_id = message.from_user.id
-    ensure_user(user_id)
+    await ensure_user(user_id)
 
     # Reset waiting state on /start
-    if user_id in USER_KEY_WAITING_STATE:
-        del USER_KEY_WAITING_STATE[user_id]
+    await conversation_state.delete(user_id)
 
     if len(message.command) > 1:
         payload = message.command[1]
         if payload.startswith("GL"):
             token = payload[2:]
-            tok = tokens_collection.find_one({"_id": token})
+            tok = await get_token(token)
             if not tok:
-                return await message.reply("⚠️ Token not found or expired. Tap **Generate Code** again.")
+                return await outbox.reply(message, "⚠️ Token not found or expired. Tap **Generate Code** again.")
             if tok.get("user_id") != user_id:
-                return await message.reply("⚠️ This verification link belongs to another account. Please generate your own.")
+                return await outbox.reply(message, "⚠️ This verification link belongs to another account. Please generate your own.")
             if tok.get("used"):
-                return await message.reply("ℹ️ This token is already verified. Tap **Generate Again** to start over.")
+                return await outbox.reply(message, "ℹ️ This token is already verified. Tap **Generate Again** to start over.")
 
             btn = InlineKeyboardMarkup([
                 [InlineKeyboardButton("Verify now by clicking me✅", callback_data=f"final_verify:{token}")]
             ])
-            return await message.reply(
+            return await outbox.reply(
+                message,
                 "✅ Short link completed!\n\nTap the button below to complete verification.",
                 reply_markup=btn
             )
 
-    buttons = [[InlineKeyboardButton("Subscribe Channel 😎", url=url)] for url in FORCE_SUB_LINKS]
-    buttons.append([InlineKeyboardButton("Verify ✅", callback_data="verify")])
-    await message.reply("**JOIN GIVEN CHANNEL TO GET REDEEM CODE**", reply_markup=InlineKeyboardMarkup(buttons))
+    channels = await get_force_sub_channels()
+    await outbox.reply(message, "**JOIN GIVEN CHANNEL TO GET REDEEM CODE**", reply_markup=force_sub_markup(channels))
 
 # --- Modified flow starts here ---
 
 @Bot.on_callback_query(filters.regex("^verify$"))
+@instrumented("verify_channels")
 async def verify_channels(bot, query):
+    if await membership.missing(bot, query.from_user.id):
+        return await outbox.answer(query, "❌ Join all the channels above first, then tap Verify again.", show_alert=True)
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
 
     join_btn = InlineKeyboardMarkup([
         [InlineKeyboardButton("Joined ✅", callback_data="joined")]
     ])
-    await bot.send_message(
+    await outbox.send_message(
+        bot,
         query.from_user.id,
         "Click Below Joined To Start.",
         reply_markup=join_btn
     )
-    await query.answer()
+    await outbox.answer(query)
 
 @Bot.on_callback_query(filters.regex("^joined$"))
+@instrumented("joined_handler")
 async def joined_handler(bot, query):
     user_id = query.from_user.id
+    # Normally all cache hits: verify_channels just confirmed these.
+    missing = await membership.missing(bot, user_id)
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
+    if missing:
+        await outbox.send_message(
+            bot,
+            user_id,
+            "**JOIN GIVEN CHANNEL TO GET REDEEM CODE**",
+            reply_markup=force_sub_markup(missing)
+        )
+        return await outbox.answer(query, "Join all channels first ❌")
 
     # Check for active key
-    current_key = get_current_admin_key()
+    current_key = await get_current_admin_key()
     if current_key is None:
         # If no key is set, proceed directly (or show an error, depending on desired behavior)
         btn = InlineKeyboardMarkup([
             [InlineKeyboardButton("Find Unused Accounts", callback_data="find_accounts")]
         ])
-        await bot.send_message(
+        await outbox.send_message(
+            bot,
             user_id,
             "Welcome to our official FF accounts bot.",
             reply_markup=btn
         )
-        await query.answer("Welcome ✅")
+        await outbox.answer(query, "Welcome ✅")
         return
 
     # Set state and prompt for key
-    USER_KEY_WAITING_STATE[user_id] = True
-    await bot.send_message(
+    await conversation_state.set(user_id, STATE_WAITING_KEY, KEY_PROMPT_TTL)
+    await outbox.send_message(
+        bot,
         user_id,
         "🔑 **Enter the Admin Login Key** to proceed. (The key is generated by the Admin.)",
         reply_markup=ForceReply(True)
     )
-    await query.answer("Enter Admin Key 🔑")
+    await outbox.answer(query, "Enter Admin Key 🔑")
 
 @Bot.on_message(filters.text & filters.private & filters.reply)
+@instrumented("key_input_handler")
 async def key_input_handler(bot, message):
     user_id = message.from_user.id
-    # Check if the user is in the key waiting state AND if they replied to the bot's prompt
-    if user_id in USER_KEY_WAITING_STATE and message.reply_to_message and "Enter the Admin Login Key" in message.reply_to_message.text:
-        del USER_KEY_WAITING_STATE[user_id]  # Clear state immediately
+    # Check if the user replied to the bot's prompt AND is in the key waiting state
+    replied_to_prompt = message.reply_to_message and "Enter the Admin Login Key" in (message.reply_to_message.text or "")
+    if replied_to_prompt and await conversation_state.pop(user_id) == STATE_WAITING_KEY:  # Clear state immediately
 
         entered_key = message.text.strip()
-        current_key = get_current_admin_key()
+        current_key = await get_current_admin_key()
 
         if current_key is None:
-            return await message.reply("❌ **Error:** No active Admin Login Key found. Please contact the Admin.")
+            return await outbox.reply(message, "❌ **Error:** No active Admin Login Key found. Please contact the Admin.")
 
         if entered_key == current_key:
             # Key is correct, proceed with the original flow
             btn = InlineKeyboardMarkup([
                 [InlineKeyboardButton("Find Unused Accounts", callback_data="find_accounts")]
             ])
-            await message.reply(
+            await outbox.reply(
+                message,
                 "✅ **Login Successful!**\n\nWelcome to our official FF accounts bot.",
                 reply_markup=btn
             )
         else:
             # Key is incorrect
-            await message.reply("❌ **Invalid Key.** Please try again with the correct Admin Login Key.")
+            await outbox.reply(message, "❌ **Invalid Key.** Please try again with the correct Admin Login Key.")
 
             # Re-prompt for key after failure
-            USER_KEY_WAITING_STATE[user_id] = True
-            await bot.send_message(
+            await conversation_state.set(user_id, STATE_WAITING_KEY, KEY_PROMPT_TTL)
+            await outbox.send_message(
+                bot,
                 user_id,
                 "🔑 **Enter the Admin Login Key** to proceed. (The key is generated by the Admin.)",
                 reply_markup=ForceReply(True)
             )
 
 @Bot.on_callback_query(filters.regex("^find_accounts$"))
+@instrumented("find_accounts")
 async def find_accounts(bot, query):
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
-    markup = InlineKeyboardMarkup([
-        [InlineKeyboardButton("India", callback_data="server:india"), InlineKeyboardButton("Singapore", callback_data="server:singapore")]
-    ])
-    await bot.send_message(
+    regions = await get_regions()
+    buttons = [InlineKeyboardButton(r["label"], callback_data=f"server:{r['_id']}") for r in regions]
+    markup = InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+    await outbox.send_message(
+        bot,
         query.from_user.id,
         "Select Your Server",
         reply_markup=markup
     )
-    await query.answer()
+    await outbox.answer(query)
 
 @Bot.on_callback_query(filters.regex(r"^server:(.+)$"))
+@instrumented("server_selected")
 async def server_selected(bot, query):
     server = query.data.split(":", 1)[1]
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
     markup = InlineKeyboardMarkup([
         [InlineKeyboardButton("Show 1 Account Result", callback_data=f"show_account:{server}")]
     ])
-    await bot.send_message(
+    await outbox.send_message(
+        bot,
         query.from_user.id,
         "We Found More Unused FF Accounts For You. Click Below To Get.",
         reply_markup=markup
     )
-    await query.answer(f"Server: {server}")
+    await outbox.answer(query, f"Server: {server}")
 
 # ───────────── NEW: show_account now sends verify link first ───────────── #
 @Bot.on_callback_query(filters.regex(r"^show_account:(.+)$"))
+@instrumented("show_account")
+@throttled("show_account")
 async def show_account(bot, query):
     user_id = query.from_user.id
     server = query.data.split(":", 1)[1]
 
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
 
-    # Create a verification token specifically for "show_account"
-    token = gen_token()
-    tokens_collection.insert_one({
-        "_id": token,
-        "user_id": user_id,
-        "used": False,
-        "purpose": "show_account",
-        "server": server,
-        "created_at": datetime.utcnow()
-    })
-
-    verify_url = await build_verify_link(bot, token)
+    # Bind a verification token specifically for "show_account"
+    verify_url = await issue_verify_link(user_id, "show_account", server)
 
     caption = (
         "🔐 **Verification Required For FF Account**\n\n"
@@ -342,35 +2257,29 @@ async def show_account(bot, query):
         [InlineKeyboardButton("How to verify ❓", url=HOW_TO_VERIFY_URL)],
     ])
 
-    await bot.send_message(
+    await outbox.send_message(
+        bot,
         user_id,
         caption,
         reply_markup=buttons,
         disable_web_page_preview=True
     )
-    await query.answer("Verification needed ✅", show_alert=False)
+    await outbox.answer(query, "Verification needed ✅", show_alert=False)
 
 # ───────────── NEW: access_gmail now also sends verify link ───────────── #
 @Bot.on_callback_query(filters.regex("^access_gmail$"))
+@instrumented("access_gmail")
+@throttled("access_gmail")
 async def access_gmail(bot, query):
     user_id = query.from_user.id
 
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
 
-    # Create a verification token specifically for "access_gmail"
-    token = gen_token()
-    tokens_collection.insert_one({
-        "_id": token,
-        "user_id": user_id,
-        "used": False,
-        "purpose": "access_gmail",
-        "created_at": datetime.utcnow()
-    })
-
-    verify_url = await build_verify_link(bot, token)
+    # Bind a verification token specifically for "access_gmail"
+    verify_url = await issue_verify_link(user_id, "access_gmail")
 
     caption = (
         "🔐 **Verification Required To Access Gmail**\n\n"
@@ -384,25 +2293,27 @@ async def access_gmail(bot, query):
         [InlineKeyboardButton("How to verify ❓", url=HOW_TO_VERIFY_URL)],
     ])
 
-    await bot.send_message(
+    await outbox.send_message(
+        bot,
         user_id,
         caption,
         reply_markup=buttons,
         disable_web_page_preview=True
     )
-    await query.answer("Verification needed ✅", show_alert=False)
+    await outbox.answer(query, "Verification needed ✅", show_alert=False)
 
 # --- end modified flow ---
 
 # ───────────────── Admin commands for per-server Gmail pools ───────────────── #
 @Bot.on_message(filters.command("keygen") & filters.private)
+@instrumented("generate_admin_key_command")
 async def generate_admin_key_command(bot, message):
     """ Admin-only. Generates a new key, expires the old one, and notifies. """
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
 
     # The expiration logic is inside the helper function
-    new_key = generate_new_admin_key()
+    new_key = await generate_new_admin_key()
 
     # 1. Notify the admin
     await message.reply(
@@ -411,10 +2322,7 @@ async def generate_admin_key_command(bot, message):
         "The old key (if any) is now expired. Users attempting to use the old key will be shown the 'Key is expired by Garena Admin' message."
     )
 
-    # 2. Get the previously expired key data to check for 'expired_by'
-    old_key_data = config_collection.find_one({"_id": ADMIN_KEY_CONFIG_ID, "expired": True})
-
-    # 3. Just info to admin (no per-user tracking implemented)
+    # 2. Just info to admin (no per-user tracking implemented)
     await message.reply(
         "**User Expiration Message Logic:**\n"
         "If a user attempts to use an expired key, the bot should show this message:\n"
@@ -422,82 +2330,274 @@ async def generate_admin_key_command(bot, message):
     )
 
 @Bot.on_message(filters.command("ingmail") & filters.private)
+@instrumented("set_ingmails")
 async def set_ingmails(bot, message):
-    """ Admin-only. Usage: /ingmail abc@mail.com def@gmail.com ... This overwrites the India pool with provided emails. """
+    """ Admin-only. Usage: /ingmail abc@mail.com def@gmail.com ... This overwrites the India pool with provided emails.
+    Or send a .txt/.csv file with caption /ingmail [append|replace]. """
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
+    if message.document:
+        return await ingest_document(bot, message, POOL_INDIA, "India Gmail pool", valid_email, message.command[1:])
     parts = message.text.split()[1:]
     if not parts:
         return await message.reply("Usage: /ingmail email1 email2 ...")
-    emails = [p.strip() for p in parts if "@" in p]
+    emails = [p.strip() for p in parts if valid_email(p.strip())]
     if not emails:
         return await message.reply("No valid emails found. Include emails separated by space.")
-    _save_pool(POOL_INDIA, emails)
-    await message.reply(f"✅ India Gmail pool updated. Total {len(emails)} emails set.")
+    added = await _save_pool(POOL_INDIA, emails)
+    await message.reply(f"✅ India Gmail pool updated. Total {added} emails set.")
 
 @Bot.on_message(filters.command("sigmail") & filters.private)
+@instrumented("set_sigmails")
 async def set_sigmails(bot, message):
-    """ Admin-only. Usage: /sigmail abc@mail.com def@gmail.com ... This overwrites the Singapore pool with provided emails. """
+    """ Admin-only. Usage: /sigmail abc@mail.com def@gmail.com ... This overwrites the Singapore pool with provided emails.
+    Or send a .txt/.csv file with caption /sigmail [append|replace]. """
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
+    if message.document:
+        return await ingest_document(bot, message, POOL_SGP, "Singapore Gmail pool", valid_email, message.command[1:])
     parts = message.text.split()[1:]
     if not parts:
         return await message.reply("Usage: /sigmail email1 email2 ...")
-    emails = [p.strip() for p in parts if "@" in p]
+    emails = [p.strip() for p in parts if valid_email(p.strip())]
     if not emails:
         return await message.reply("No valid emails found. Include emails separated by space.")
-    _save_pool(POOL_SGP, emails)
-    await message.reply(f"✅ Singapore Gmail pool updated. Total {len(emails)} emails set.")
+    added = await _save_pool(POOL_SGP, emails)
+    await message.reply(f"✅ Singapore Gmail pool updated. Total {added} emails set.")
+
+# ───────────────── Pool inspection & export ───────────────── #
+# Pages are keyset-paginated on _id over the (pool, status, _id) index, so a
+# page costs the same whether the pool holds 10 or 10 million entries; the
+# total comes from the cached pool_size().
+POOL_PAGE_SIZE = int(os.getenv("POOL_PAGE_SIZE", "40"))
+
+def _pool_page_sync(key: str, after=None, before=None):
+    """ Returns (docs, has_prev, has_next) for the page after/before an _id. """
+    query = {"pool": key, "status": POOL_IN_STOCK}
+    if before is not None:
+        query["_id"] = {"$lt": before}
+        docs = list(pool_items_collection.find(query, {"value": 1}).sort("_id", DESCENDING).limit(POOL_PAGE_SIZE + 1))
+        has_prev = len(docs) > POOL_PAGE_SIZE
+        return docs[:POOL_PAGE_SIZE][::-1], has_prev, True
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    docs = list(pool_items_collection.find(query, {"value": 1}).sort("_id", ASCENDING).limit(POOL_PAGE_SIZE + 1))
+    return docs[:POOL_PAGE_SIZE], after is not None, len(docs) > POOL_PAGE_SIZE
+
+async def render_pool_page(key: str, after=None, before=None):
+    docs, has_prev, has_next = await run_db(_pool_page_sync, key, after, before)
+    total = await pool_size(key)
+    label = await pool_label(key)
+    if not docs:
+        return f"{label} is empty." if not total else f"{label}: no more entries.", None
+    lines = "\n".join(f"`{doc['value'][:80]}`" for doc in docs)
+    text = f"**{label}** — {total} available (first shown will be popped on use):\n\n{lines}"
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"pg:{key}:p:{docs[0]['_id']}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"pg:{key}:n:{docs[-1]['_id']}"))
+    return text, InlineKeyboardMarkup([nav]) if nav else None
+
+async def show_pool(message, key: str):
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    text, markup = await render_pool_page(key)
+    await message.reply(text, reply_markup=markup)
 
 @Bot.on_message(filters.command("show_ingmail") & filters.private)
+@instrumented("show_ingmails")
 async def show_ingmails(bot, message):
-    if message.from_user.id not in ADMINS:
-        return await message.reply("You are not authorized to use this command.")
-    gmails = _load_pool(POOL_INDIA)
-    if not gmails:
-        return await message.reply("India Gmail pool is empty.")
-    # show up to first 2000 characters (Telegram message limit safety)
-    text = "India Gmail pool (first shown will be popped on use):\n\n" + "\n".join(gmails)
-    await message.reply(text)
+    await show_pool(message, POOL_INDIA)
 
 @Bot.on_message(filters.command("show_sigmail") & filters.private)
+@instrumented("show_sigmails")
 async def show_sigmails(bot, message):
+    await show_pool(message, POOL_SGP)
+
+@Bot.on_message(filters.command("show_codes") & filters.private)
+@instrumented("show_codes")
+async def show_codes(bot, message):
+    await show_pool(message, CODES_POOL)
+
+@Bot.on_message(filters.command("show_pool") & filters.private)
+@instrumented("show_any_pool")
+async def show_any_pool(bot, message):
+    """ Admin-only. Usage: /show_pool <region|codes> """
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    resolved = await resolve_pool(message.command[1]) if len(message.command) > 1 else None
+    if resolved is None:
+        return await message.reply("Usage: /show_pool <region|codes>")
+    await show_pool(message, resolved[0])
+
+@Bot.on_callback_query(filters.regex(r"^pg:([^:]+):([pn]):([0-9a-f]{24})$"))
+@instrumented("pool_page")
+async def pool_page(bot, query):
+    if query.from_user.id not in ADMINS:
+        return await query.answer("Not authorized.", show_alert=True)
+    key, direction, cursor = query.matches[0].groups()
+    try:
+        cursor = ObjectId(cursor)
+    except InvalidId:
+        return await query.answer()
+    if direction == "n":
+        text, markup = await render_pool_page(key, after=cursor)
+    else:
+        text, markup = await render_pool_page(key, before=cursor)
+    await query.message.edit_text(text, reply_markup=markup)
+    await query.answer()
+
+def _export_pool_sync(key: str, path: str) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        cursor = pool_items_collection.find(
+            {"pool": key, "status": POOL_IN_STOCK}, {"_id": 0, "value": 1}
+        ).sort("_id", ASCENDING).batch_size(5000)
+        for doc in cursor:
+            f.write(doc["value"] + "\n")
+            count += 1
+    return count
+
+@Bot.on_message(filters.command("export") & filters.private)
+@instrumented("export_pool")
+async def export_pool(bot, message):
+    """ Admin-only. Usage: /export <region|codes> — uploads the available entries as a .txt file. """
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
-    gmails = _load_pool(POOL_SGP)
-    if not gmails:
-        return await message.reply("Singapore Gmail pool is empty.")
-    text = "Singapore Gmail pool (first shown will be popped on use):\n\n" + "\n".join(gmails)
-    await message.reply(text)
+    resolved = await resolve_pool(message.command[1]) if len(message.command) > 1 else None
+    if resolved is None:
+        return await message.reply("Usage: /export <region|codes>")
+    key, label = resolved
+    fd, path = tempfile.mkstemp(prefix=f"{key}-", suffix=".txt")
+    os.close(fd)
+    try:
+        count = await run_db(_export_pool_sync, key, path)
+        await message.reply_document(path, file_name=f"{key}-{datetime.utcnow():%Y%m%d-%H%M%S}.txt",
+                                     caption=f"{label}: {count} available entries")
+    finally:
+        os.remove(path)
 
 @Bot.on_message(filters.command("clear_ingmail") & filters.private)
+@instrumented("clear_ingmails")
 async def clear_ingmails(bot, message):
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
-    _save_pool(POOL_INDIA, [])
+    await _save_pool(POOL_INDIA, [])
     await message.reply("✅ India Gmail pool cleared.")
 
 @Bot.on_message(filters.command("clear_sigmail") & filters.private)
+@instrumented("clear_sigmails")
 async def clear_sigmails(bot, message):
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
-    _save_pool(POOL_SGP, [])
+    await _save_pool(POOL_SGP, [])
     await message.reply("✅ Singapore Gmail pool cleared.")
 
+@Bot.on_message(filters.command("gmail") & filters.private)
+@instrumented("set_region_gmails")
+async def set_region_gmails(bot, message):
+    """ Admin-only. Usage: /gmail <region> email1 email2 ... (overwrites), or a .txt/.csv file with caption /gmail <region> [append|replace]. """
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    region = await get_region(message.command[1]) if len(message.command) > 1 else None
+    if region is None:
+        return await message.reply("Usage: /gmail <region> email1 email2 ...  (see /region list)")
+    label = f"{region['label']} Gmail pool"
+    if message.document:
+        return await ingest_document(bot, message, region["pool"], label, valid_email, message.command[2:])
+    emails = [p.strip() for p in message.text.split()[2:] if valid_email(p.strip())]
+    if not emails:
+        return await message.reply("No valid emails found. Include emails separated by space.")
+    added = await _save_pool(region["pool"], emails)
+    await message.reply(f"✅ {label} updated. Total {added} emails set.")
+
+@Bot.on_message(filters.command("region") & filters.private)
+@instrumented("manage_regions")
+async def manage_regions(bot, message):
+    """ Admin-only. Usage: /region list | /region add <id> <label> | /region remove <id> """
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    args = message.command[1:]
+    action = args[0].lower() if args else "list"
+    if action == "add" and len(args) >= 3:
+        region_id = args[1].lower()
+        if not REGION_ID_RE.match(region_id):
+            return await message.reply("Region id must be 1-10 chars of a-z, 0-9 or _.")
+        label = " ".join(args[2:])
+        last = await run_db(regions_collection.find_one, {}, sort=[("order", DESCENDING)])
+        await run_db(
+            regions_collection.update_one,
+            {"_id": region_id},
+            {"$set": {"label": label, "enabled": True},
+             "$setOnInsert": {"pool": f"gmails_{region_id}", "order": (last or {}).get("order", 0) + 1,
+                              "created_at": datetime.utcnow()}},
+            upsert=True
+        )
+        config_cache.invalidate("regions")
+        return await message.reply(f"✅ Region `{region_id}` ({label}) enabled. Fill it with /gmail {region_id} ...")
+    if action == "remove" and len(args) == 2:
+        result = await run_db(regions_collection.update_one, {"_id": args[1].lower()}, {"$set": {"enabled": False}})
+        config_cache.invalidate("regions")
+        if not result.matched_count:
+            return await message.reply("Unknown region.")
+        return await message.reply(f"✅ Region `{args[1].lower()}` disabled. Its pool is kept.")
+    if action != "list":
+        return await message.reply("Usage: /region list | /region add <id> <label> | /region remove <id>")
+    regions = await get_regions()
+    lines = [f"`{r['_id']}` — {r['label']} (pool `{r['pool']}`)" for r in regions]
+    await message.reply("**Regions**\n\n" + ("\n".join(lines) or "None enabled."))
+
+@Bot.on_message(filters.command("forcesub") & filters.private)
+@instrumented("manage_force_sub")
+async def manage_force_sub(bot, message):
+    """ Admin-only. Usage: /forcesub list | /forcesub add <chat_id> <url> | /forcesub remove <chat_id|url> """
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    args = message.command[1:]
+    action = args[0].lower() if args else "list"
+    if action == "add" and len(args) == 3:
+        chat_id = int(args[1]) if args[1].lstrip("-").isdigit() else args[1]
+        try:
+            await bot.get_chat_member(chat_id, "me")
+        except Exception as e:
+            return await message.reply(f"❌ Can't check members of `{chat_id}`: {e}\nAdd the bot to that channel as an admin first.")
+        await run_db(config_collection.update_one, {"_id": FORCE_SUB_CONFIG_ID}, {"$pull": {"channels": {"url": args[2]}}}, upsert=True)
+        await run_db(config_collection.update_one, {"_id": FORCE_SUB_CONFIG_ID}, {"$push": {"channels": {"chat_id": chat_id, "url": args[2]}}})
+        config_cache.invalidate(FORCE_SUB_CONFIG_ID)
+        return await message.reply(f"✅ Force-subscribe channel `{chat_id}` added.")
+    if action == "remove" and len(args) == 2:
+        matches = [c for c in await get_force_sub_channels() if args[1] in (str(c.get("chat_id")), c["url"])]
+        if not matches:
+            return await message.reply("Unknown channel.")
+        await run_db(config_collection.update_one, {"_id": FORCE_SUB_CONFIG_ID}, {"$pull": {"channels": {"url": matches[0]["url"]}}})
+        config_cache.invalidate(FORCE_SUB_CONFIG_ID)
+        return await message.reply("✅ Channel removed.")
+    if action != "list":
+        return await message.reply("Usage: /forcesub list | /forcesub add <chat_id> <url> | /forcesub remove <chat_id|url>")
+    channels = await get_force_sub_channels()
+    lines = [f"`{c.get('chat_id') or 'unchecked'}` — {c['url']}" for c in channels]
+    await message.reply("**Force-subscribe channels**\n\n" + ("\n".join(lines) or "None."))
+
+@Bot.on_message(filters.command("stock") & filters.private)
+@instrumented("stock_report")
+async def stock_report(bot, message):
+    """ Admin-only. Available entries for every region plus redeem codes, from one aggregation. """
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    stock, regions = await asyncio.gather(run_db(_stock_sync), get_regions())
+    lines = [f"{r['label']}: {stock.get(r['pool'], 0)}" for r in regions]
+    lines.append(f"Redeem codes: {stock.get(CODES_POOL, 0)}")
+    await message.reply("📦 **Stock**\n\n" + "\n".join(lines))
+
 # ───────────────── Existing verify/gen_code handlers (MODIFIED) ───────────────── #
 @Bot.on_callback_query(filters.regex("^gen_code$"))
+@instrumented("generate_code")
+@throttled("gen_code")
 async def generate_code(bot, query):
     user_id = query.from_user.id
-    ensure_user(user_id)
-    token = gen_token()
-    tokens_collection.insert_one({
-        "_id": token,
-        "user_id": user_id,
-        "used": False,
-        "purpose": "redeem",  # mark as redeem-purpose
-        "created_at": datetime.utcnow()
-    })
-    verify_url = await build_verify_link(bot, token)
+    await ensure_user(user_id)
+    verify_url = await issue_verify_link(user_id, "redeem")  # mark as redeem-purpose
     caption = (
         "🔐 **Verification Required**\n\n"
         "1) Tap **Verify (Click me)** and complete the steps.\n"
@@ -509,41 +2609,40 @@ async def generate_code(bot, query):
         [InlineKeyboardButton("How to verify ❓", url=HOW_TO_VERIFY_URL)],
     ])
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
-    await bot.send_message(user_id, caption, reply_markup=buttons, disable_web_page_preview=True)
-    await query.answer()
+    await outbox.send_message(bot, user_id, caption, reply_markup=buttons, disable_web_page_preview=True)
+    await outbox.answer(query)
 
 # ───────────────── final_verify with multi-purpose support ───────────────── #
 @Bot.on_callback_query(filters.regex(r"^final_verify:(.+)$"))
+@instrumented("final_verify")
 async def final_verify(bot, query):
     user_id = query.from_user.id
     token = query.data.split(":", 1)[1]
 
-    tok = tokens_collection.find_one({"_id": token})
-    if not tok:
-        return await query.answer("Token not found or expired.", show_alert=True)
-    if tok.get("user_id") != user_id:
-        return await query.answer("This token belongs to another account.", show_alert=True)
-    if tok.get("used"):
+    tok, reason = await redeem_token(token, user_id)
+    if reason == "missing":
+        return await outbox.answer(query, "Token not found or expired.", show_alert=True)
+    if reason == "foreign":
+        return await outbox.answer(query, "This token belongs to another account.", show_alert=True)
+    if reason == "used":
         purpose = tok.get("purpose", "redeem")
         if purpose == "show_account":
-            return await query.answer("Already verified. Tap *Show 1 Account Result* again.", show_alert=True)
+            return await outbox.answer(query, "Already verified. Tap *Show 1 Account Result* again.", show_alert=True)
         elif purpose == "access_gmail":
-            return await query.answer("Already verified. Tap *Access Gmail* again.", show_alert=True)
+            return await outbox.answer(query, "Already verified. Tap *Access Gmail* again.", show_alert=True)
         else:
-            return await query.answer("Token already verified. Use Generate Again.", show_alert=True)
-
-    # Mark token used
-    tokens_collection.update_one({"_id": token}, {"$set": {"used": True, "used_at": datetime.utcnow()}})
+            return await outbox.answer(query, "Token already verified. Use Generate Again.", show_alert=True)
 
     purpose = tok.get("purpose", "redeem")  # default to redeem for older tokens
 
     # ── 1) Redeem Code Flow ───────────────────────────── #
     if purpose == "redeem":
-        code = get_current_code()
+        code = await get_current_code()
 
+        analytics.track("dispensed" if code else "stock_out", user_id, server=CODES_POOL)
         if not code:
             caption = "❌ No redeem codes available right now. Please try again later."
         else:
@@ -556,18 +2655,20 @@ async def final_verify(bot, query):
             [InlineKeyboardButton("Generate Again", callback_data="gen_code")]
         ])
         try:
-            await query.message.delete()
+            await outbox.delete(query.message)
         except Exception:
             pass
-        await bot.send_message(user_id, caption, reply_markup=buttons, disable_web_page_preview=True)
-        return await query.answer("Verified ✅")
+        await outbox.send_message(bot, user_id, caption, reply_markup=buttons, disable_web_page_preview=True)
+        return await outbox.answer(query, "Verified ✅")
 
     # ── 2) Show FF Account Gmail After Verification ───── #
     if purpose == "show_account":
-        server = tok.get("server", "india")
-        pool_key = POOL_INDIA if server.lower() == "india" else POOL_SGP
+        server = tok.get("server") or "india"
+        region = await get_region(server)
 
-        gmail = pop_from_pool(pool_key)
+        # An unknown or disabled server has nothing to hand out.
+        gmail = await pop_from_pool(region["pool"]) if region else None
+        analytics.track("stock_out" if gmail is None else "dispensed", user_id, server=server)
 
         if gmail is None:
             caption = (
@@ -597,17 +2698,18 @@ async def final_verify(bot, query):
             ])
 
         try:
-            await query.message.delete()
+            await outbox.delete(query.message)
         except Exception:
             pass
 
-        await bot.send_message(
+        await outbox.send_message(
+            bot,
             user_id,
             caption,
             reply_markup=buttons,
             disable_web_page_preview=True
         )
-        return await query.answer("Verified ✅")
+        return await outbox.answer(query, "Verified ✅")
 
     # ── 3) Access Gmail verification (stub) ───────────── #
     if purpose == "access_gmail":
@@ -622,78 +2724,993 @@ async def final_verify(bot, query):
         ])
 
         try:
-            await query.message.delete()
+            await outbox.delete(query.message)
         except Exception:
             pass
 
-        await bot.send_message(
+        await outbox.send_message(
+            bot,
             user_id,
             caption,
             reply_markup=buttons,
             disable_web_page_preview=True
         )
-        return await query.answer("Verified ✅")
+        return await outbox.answer(query, "Verified ✅")
 
     # ── Fallback (unknown purpose) ─────────────────────── #
     try:
-        await query.message.delete()
+        await outbox.delete(query.message)
     except Exception:
         pass
 
-    await bot.send_message(
+    await outbox.send_message(
+        bot,
         user_id,
         "✅ Verification completed, but I couldn't detect the purpose of this token.\n"
         "Please try the action again.",
     )
-    return await query.answer("Verified ✅")
+    return await outbox.answer(query, "Verified ✅")
 
 # ───────────────── Admin ───────────────── #
 @Bot.on_message(filters.command("time") & filters.private)
+@instrumented("set_codes")
 async def set_codes(bot, message):
+    """ Admin-only. Usage: /time CODE1 CODE2 ... (replaces the codes), or a .txt/.csv file with caption /time [append|replace]. """
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
+    if message.document:
+        return await ingest_document(bot, message, CODES_POOL, "Redeem codes", valid_code, message.command[1:])
     try:
         parts = message.text.split()[1:]  # skip "/time"
         if not parts:
             return await message.reply("Usage: /time CODE1 CODE2 CODE3 ...")
-        save_codes(parts)
-        await message.reply(f"✅ Codes updated successfully!\n\nTotal {len(parts)} codes set.")
+        added = await save_codes(parts)
+        await message.reply(f"✅ Codes updated successfully!\n\nTotal {added} codes set.")
     except Exception as e:
         await message.reply(f"Error: {e}")
 
+@Bot.on_message(filters.command("profile") & filters.private)
+@instrumented("profile")
+async def profile_command(bot, message):
+    """ Admin-only. Usage: /profile [seconds] — samples live traffic and uploads a folded-stack file. """
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    try:
+        seconds = min(max(float(message.command[1]), 1), 120) if len(message.command) > 1 else 10
+    except ValueError:
+        return await message.reply("Usage: /profile [seconds]")
+    if _profile_lock.locked():
+        return await message.reply("A profile is already running.")
+    async with _profile_lock:
+        await message.reply(f"⏱ Profiling for {seconds:g}s...")
+        sampler = AsyncSampler(asyncio.get_running_loop(), PROFILE_INTERVAL)
+        await asyncio.get_running_loop().run_in_executor(None, sampler.run, seconds)
+
+    def fmt(rows):
+        total = sum(sampler.folded.values()) or 1
+        return "\n".join(f"{count * 100 / total:5.1f}%  `{frame}`" for frame, count in rows) or "—"
+    await message.reply(
+        f"**Profile: {sampler.samples} ticks over {seconds:g}s**\n\n"
+        f"**On-CPU hot spots**\n{fmt(sampler.hot_spots('cpu'))}\n\n"
+        f"**Where tasks wait**\n{fmt(sampler.hot_spots('await'))}"
+    )
+    document = io.BytesIO(sampler.folded_text().encode())
+    document.name = f"profile-{datetime.utcnow():%Y%m%d-%H%M%S}.folded"
+    await message.reply_document(document, caption="Folded stacks — open with speedscope.app or flamegraph.pl")
+
+@Bot.on_message(filters.command("cachestats") & filters.private)
+@instrumented("cache_stats")
+async def cache_stats(bot, message):
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    stats = config_cache.stats()
+    lines = [f"`{key}`: {hits} hits / {misses} misses" for key, (hits, misses) in stats["keys"].items()]
+    await message.reply(
+        f"**Config cache** (TTL {CONFIG_CACHE_TTL:g}s, change stream {'on' if CONFIG_WATCH else 'off'})\n\n"
+        f"Hits: {stats['hits']}\nMisses: {stats['misses']}\n\n" + "\n".join(lines)
+    )
+
+@Bot.on_message(filters.command("stats") & filters.private)
+@instrumented("funnel_stats")
+async def funnel_stats(bot, message):
+    """ Admin-only. Usage: /stats [days] — funnel conversion, dispenses per server and step latency from rollups. """
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    args = message.command[1:]
+    days = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 1
+    await analytics.flush()
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    docs = await run_db(lambda: list(funnel_daily_collection.find({"day": {"$gte": since}})))
+
+    counts = collections.Counter()
+    latency = collections.defaultdict(collections.Counter)
+    per_server = {"dispensed": collections.Counter(), "stock_out": collections.Counter()}
+    for doc in docs:
+        counts[doc["step"]] += doc.get("count", 0)
+        latency[doc["step"]].update(doc.get("lat", {}))
+        if doc["step"] in per_server:
+            per_server[doc["step"]][doc.get("server") or "-"] += doc.get("count", 0)
+
+    lines = []
+    previous = None
+    for step in FUNNEL_ORDER:
+        n = counts[step]
+        line = f"`{step}`: {n}"
+        if counts["start"] and step != "start":
+            line += f" ({n / counts['start']:.0%} of start"
+            line += f", {n / counts[previous]:.0%} of prev)" if counts[previous] else ")"
+        lat = latency[step]
+        if lat:
+            line += f" · p50 {bucket_percentile(lat, 0.5)} ms, p95 {bucket_percentile(lat, 0.95)} ms"
+        lines.append(line)
+        previous = step
+    servers = sorted(set(per_server["dispensed"]) | set(per_server["stock_out"]))
+    server_lines = [
+        f"`{s}`: {per_server['dispensed'][s]} dispensed, {per_server['stock_out'][s]} out of stock" for s in servers
+    ]
+    await message.reply(
+        f"📊 **Funnel, last {days} day(s)**\n\n" + "\n".join(lines)
+        + "\n\n**Dispensed per server**\n" + ("\n".join(server_lines) or "None yet.")
+    )
+
+# ───────────────── Broadcast engine ───────────────── #
+# A broadcast is a job document in `broadcasts`. The runner walks users in _id
+# order one batch at a time, sends the batch with bounded concurrency as BULK
+# outbox traffic (behind every interactive reply), then checkpoints `last_id`
+# and the counters. A restart resumes every "running" job from its checkpoint
+# (at most one batch repeats). In pool mode only the receiver runs jobs: a
+# /broadcast handled by a worker just stores the job, and the receiver picks
+# it up within BROADCAST_POLL seconds.
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # bulk share of OUTBOUND_RATE
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_POLL = float(os.getenv("BROADCAST_POLL", "5"))
+RUNS_BROADCASTS = BOT_ROLE != "worker"
+
+broadcast_limiter = AsyncRateLimiter(BROADCAST_RATE)
+BROADCAST_TASKS = {}  # job_id -> asyncio.Task
+BROADCAST_STATS = {}  # job_id -> live counters of a job running in this process
+
+async def _broadcast_send(bot, chat_id: int, text: str, stats: dict):
+    # The outbox retries FloodWait itself; what reaches us here is final.
+    await broadcast_limiter.acquire()
+    try:
+        await outbox.send_message(bot, chat_id, text, priority=BULK)
+        stats["sent"] += 1
+    except (UserIsBlocked, InputUserDeactivated, UserDeactivated, PeerIdInvalid):
+        stats["blocked"] += 1
+    except Exception as e:
+        log.warning("broadcast to %s failed: %s", chat_id, e)
+        stats["failed"] += 1
+
+async def run_broadcast(bot, job_id):
+    job = await run_db(broadcasts_collection.find_one, {"_id": job_id})
+    stats = BROADCAST_STATS[job_id] = {k: job.get(k, 0) for k in ("sent", "failed", "blocked")}
+    last_id = job.get("last_id")
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send(chat_id):
+        async with semaphore:
+            await _broadcast_send(bot, chat_id, job["text"], stats)
+
+    try:
+        while True:
+            ids = await fetch_user_id_batch(last_id, BROADCAST_BATCH)
+            if not ids:
+                break
+            await asyncio.gather(*(send(chat_id) for chat_id in ids))
+            last_id = ids[-1]
+            # Conditional on "running": /bcancel may have been handled by another process.
+            result = await run_db(
+                broadcasts_collection.update_one,
+                {"_id": job_id, "status": "running"},
+                {"$set": {"last_id": last_id, "updated_at": datetime.utcnow(), **stats}}
+            )
+            if result.matched_count == 0:
+                return await _broadcast_stopped(job_id, stats)
+        result = await run_db(
+            broadcasts_collection.update_one,
+            {"_id": job_id, "status": "running"},
+            {"$set": {"status": "done", "finished_at": datetime.utcnow(), **stats}}
+        )
+        if result.matched_count == 0:
+            return await _broadcast_stopped(job_id, stats)
+        await outbox.send_message(
+            bot,
+            job["created_by"],
+            f"✅ Broadcast finished.\n\nSent: {stats['sent']}\nBlocked: {stats['blocked']}\nFailed: {stats['failed']}"
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        log.exception("broadcast %s crashed", job_id)
+        await run_db(
+            broadcasts_collection.update_one,
+            {"_id": job_id, "status": "running"},
+            {"$set": {"status": "failed", "error": str(e), **stats}}
+        )
+    finally:
+        BROADCAST_TASKS.pop(job_id, None)
+
+async def _broadcast_stopped(job_id, stats):
+    """ The job left "running" under us (cancelled elsewhere): keep its counters, not its status. """
+    log.info("broadcast %s is no longer running, stopping", job_id)
+    await run_db(broadcasts_collection.update_one, {"_id": job_id}, {"$set": stats})
+
+def start_broadcast_task(bot, job_id):
+    BROADCAST_TASKS[job_id] = asyncio.create_task(run_broadcast(bot, job_id))
+
+async def resume_broadcasts(bot):
+    """ Start every running job that has no task in this process. """
+    jobs = await run_db(lambda: list(broadcasts_collection.find({"status": "running"}, {"_id": 1})))
+    for job in jobs:
+        if job["_id"] not in BROADCAST_TASKS:
+            log.info("resuming broadcast %s", job["_id"])
+            start_broadcast_task(bot, job["_id"])
+
+async def poll_broadcasts(bot):
+    """ Pool-mode receiver: pick up jobs that workers stored. """
+    while True:
+        await asyncio.sleep(BROADCAST_POLL)
+        try:
+            await resume_broadcasts(bot)
+        except Exception as e:
+            log.warning("broadcast poll failed: %s", e)
+
 @Bot.on_message(filters.command("broadcast") & filters.private)
+@instrumented("broadcast")
 async def broadcast(bot, message):
     if message.from_user.id not in ADMINS:
         return await message.reply("You are not authorized to use this command.")
     if len(message.command) < 2:
         return await message.reply("Usage: /broadcast <your message>")
     broadcast_text = message.text.split(None, 1)[1]
-    count = 0
-    for user in users_collection.find():
+    result = await run_db(broadcasts_collection.insert_one, {
+        "text": broadcast_text,
+        "status": "running",
+        "created_by": message.from_user.id,
+        "started_at": datetime.utcnow(),
+        "last_id": None,
+        "sent": 0, "failed": 0, "blocked": 0
+    })
+    if RUNS_BROADCASTS:
+        start_broadcast_task(bot, result.inserted_id)
+    await message.reply(f"📣 Broadcast started in the background.\n\nJob: `{result.inserted_id}`\nUse /bstatus to follow it.")
+
+@Bot.on_message(filters.command("bstatus") & filters.private)
+@instrumented("broadcast_status")
+async def broadcast_status(bot, message):
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    job = await run_db(broadcasts_collection.find_one, {}, sort=[("_id", -1)])
+    if not job:
+        return await message.reply("No broadcasts yet.")
+    stats = BROADCAST_STATS.get(job["_id"]) or {k: job.get(k, 0) for k in ("sent", "failed", "blocked")}
+    done = sum(stats.values())
+    end = job.get("finished_at") or datetime.utcnow()
+    elapsed = max((end - job["started_at"]).total_seconds(), 1)
+    await message.reply(
+        f"**Broadcast** `{job['_id']}` — {job['status']}\n\n"
+        f"Sent: {stats['sent']}\nBlocked: {stats['blocked']}\nFailed: {stats['failed']}\n"
+        f"Throughput: {done / elapsed:.1f} msg/s"
+    )
+
+@Bot.on_message(filters.command("bcancel") & filters.private)
+@instrumented("broadcast_cancel")
+async def broadcast_cancel(bot, message):
+    if message.from_user.id not in ADMINS:
+        return await message.reply("You are not authorized to use this command.")
+    jobs = await run_db(lambda: list(broadcasts_collection.find({"status": "running"}, {"_id": 1})))
+    for job in jobs:
+        await run_db(broadcasts_collection.update_one, {"_id": job["_id"]}, {"$set": {"status": "cancelled", "finished_at": datetime.utcnow()}})
+        task = BROADCAST_TASKS.get(job["_id"])
+        if task:
+            task.cancel()
+    await message.reply(f"🛑 Cancelled {len(jobs)} running broadcast(s).")
+
+# ───────────────── Schema bootstrap & migrations ───────────────── #
+TOKEN_TTL_SECONDS = int(os.getenv("TOKEN_TTL_SECONDS", str(3 * 24 * 3600)))
+MIGRATION_BATCH = int(os.getenv("MIGRATION_BATCH", "1000"))
+SCHEMA_VERSION_ID = "schema_version"
+SCHEMA_LOCK_ID = "schema_lock"
+
+def _ensure_ttl_index(collection, field: str, seconds: int):
+    """ Create a TTL index, or retune expireAfterSeconds if it already exists with another value. """
+    try:
+        collection.create_index(field, expireAfterSeconds=seconds, name=f"{field}_ttl")
+    except OperationFailure as e:
+        if e.code not in (85, 86):  # IndexOptionsConflict / IndexKeySpecsConflict
+            raise
+        db.command("collMod", collection.name, index={"name": f"{field}_ttl", "expireAfterSeconds": seconds})
+
+def ensure_indexes():
+    """ Idempotent: safe to run on every start. """
+    _ensure_ttl_index(tokens_collection, "created_at", TOKEN_TTL_SECONDS)
+    _ensure_ttl_index(used_tokens_collection, "expires_at", 0)
+    pool_items_collection.create_index(
+        [("pool", ASCENDING), ("status", ASCENDING), ("_id", ASCENDING)],
+        name="pool_status_order"
+    )
+    broadcasts_collection.create_index("status", name="status")
+    pool_items_collection.create_index([("status", ASCENDING), ("pool", ASCENDING)], name="status_pool")
+    _ensure_ttl_index(conversation_state_collection, "expires_at", 0)
+    _ensure_ttl_index(throttle_collection, "expires_at", 0)
+    if "events" not in db.list_collection_names():
         try:
-            await bot.send_message(chat_id=user['_id'], text=broadcast_text)
-            count += 1
-        except:
-            continue
-    await message.reply(f"Broadcast sent to {count} users.")
+            db.create_collection(
+                "events",
+                timeseries={"timeField": "ts", "metaField": "meta", "granularity": "minutes"},
+                expireAfterSeconds=ANALYTICS_RETENTION_DAYS * 86400
+            )
+        except OperationFailure as e:
+            # Pre-5.0 servers: a plain collection with a TTL index does the same job.
+            log.warning("time-series events collection unavailable (%s), using a TTL index", e)
+            _ensure_ttl_index(events_collection, "ts", ANALYTICS_RETENTION_DAYS * 86400)
+    funnel_daily_collection.create_index("day", name="day")
+    pool_items_collection.create_index("lease_id", name="lease_id", sparse=True)
+    # Only staged rows carry staged_at; a swapped-in batch unsets it.
+    _ensure_ttl_index(pool_items_collection, "staged_at", INGEST_STAGED_TTL)
+    pool_items_collection.create_index("batch", name="batch", sparse=True)
+
+def _migrate_config_array(doc_id: str, field: str, pool: str):
+    """ Move a config document's array into pool_items, one batch at a time. """
+    while True:
+        doc = config_collection.find_one({"_id": doc_id}, {field: {"$slice": [0, MIGRATION_BATCH]}})
+        chunk = (doc or {}).get(field) or []
+        if not chunk:
+            break
+        now = datetime.utcnow()
+        # Upserts keyed on (pool, value) make a batch safe to replay after a crash.
+        pool_items_collection.bulk_write([
+            UpdateOne(
+                {"pool": pool, "value": value, "status": POOL_IN_STOCK},
+                {"$setOnInsert": {"pool": pool, "value": value, "status": POOL_AVAILABLE, "added_at": now}},
+                upsert=True
+            ) for value in chunk
+        ], ordered=True)
+        # Drop the migrated head so the next pass (or a restart) picks up where
+        # this one stopped; only if it is still this chunk, so a concurrent
+        # drain of the same array cannot drop a batch nobody copied.
+        config_collection.update_one(
+            {"_id": doc_id},
+            [{"$set": {field: {"$cond": [
+                {"$eq": [{"$slice": [f"${field}", len(chunk)]}, {"$literal": chunk}]},
+                {"$slice": [f"${field}", len(chunk), 2 ** 31 - 1]},
+                f"${field}"
+            ]}}}]
+        )
+        log.info("migrated %d entries of %s", len(chunk), doc_id)
+    config_collection.update_one(
+        {"_id": doc_id, f"{field}.0": {"$exists": False}},
+        {"$unset": {field: ""}, "$set": {"migrated_at": datetime.utcnow()}}
+    )
+
+def migrate_pool_arrays():
+    """ v1: move the `list` arrays of the old config pool documents into pool_items. """
+    for key in (POOL_INDIA, POOL_SGP):
+        _drain_legacy_pool_sync(key)
+
+def migrate_codes_array():
+    """ v2: move the config `codes` array into pool_items under CODES_POOL. """
+    _drain_legacy_pool_sync(CODES_POOL)
+
+def migrate_unique_pool_values():
+    """ v3: drop repeated (pool, value) entries, then enforce uniqueness. """
+    duplicates = pool_items_collection.aggregate([
+        {"$group": {"_id": {"pool": "$pool", "value": "$value"}, "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    for group in duplicates:
+        pool_items_collection.delete_many({"_id": {"$in": sorted(group["ids"])[1:]}})
+    pool_items_collection.create_index(
+        [("pool", ASCENDING), ("value", ASCENDING)],
+        unique=True,
+        name="pool_value_unique"
+    )
+
+def scope_unique_pool_values():
+    """ v6: uniqueness covers in-stock entries only, so a dispensed value can be stocked again. """
+    # Same key pattern: the old index has to go before the partial one can be built.
+    if "pool_value_unique" in pool_items_collection.index_information():
+        pool_items_collection.drop_index("pool_value_unique")
+    try:
+        pool_items_collection.create_index(
+            [("pool", ASCENDING), ("value", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"status": POOL_IN_STOCK},
+            name="pool_value_in_stock"
+        )
+    except OperationFailure as e:
+        # $in in a partial filter needs MongoDB 6.0; before that, cover available entries.
+        log.warning("partial index on in-stock statuses unavailable (%s), covering available only", e)
+        pool_items_collection.create_index(
+            [("pool", ASCENDING), ("value", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"status": POOL_AVAILABLE},
+            name="pool_value_in_stock"
+        )
+
+def seed_default_regions():
+    """ v4: register the two servers that used to be hardcoded. """
+    for region in DEFAULT_REGIONS:
+        regions_collection.update_one(
+            {"_id": region["_id"]},
+            {"$setOnInsert": {**region, "enabled": True, "created_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+def seed_force_sub_channels():
+    """ v5: move the hardcoded invite links into config (no chat ids, so unchecked until /forcesub add). """
+    config_collection.update_one(
+        {"_id": FORCE_SUB_CONFIG_ID},
+        {"$setOnInsert": {"channels": [{"chat_id": None, "url": url} for url in DEFAULT_FORCE_SUB_LINKS]}},
+        upsert=True
+    )
+
+# (version, description, function). Append only; each runs once, in order.
+MIGRATIONS = [
+    (1, "pool arrays -> pool_items documents", migrate_pool_arrays),
+    (2, "codes array -> pool_items documents", migrate_codes_array),
+    (3, "unique (pool, value) in pool_items", migrate_unique_pool_values),
+    (4, "seed default regions", seed_default_regions),
+    (5, "seed force-subscribe channels", seed_force_sub_channels),
+    (6, "unique (pool, value) in stock only", scope_unique_pool_values),
+]
+
+def run_migrations():
+    """ Apply pending migrations under a lease lock so concurrent workers don't race. """
+    owner = f"{os.uname().nodename}:{os.getpid()}"
+    now = datetime.utcnow()
+    try:
+        config_collection.update_one(
+            {"_id": SCHEMA_LOCK_ID, "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(minutes=10)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        log.info("another worker is running migrations; skipping")
+        return
+    try:
+        current = (config_collection.find_one({"_id": SCHEMA_VERSION_ID}) or {}).get("version", 0)
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            log.info("running migration %d: %s", version, description)
+            migrate()
+            config_collection.update_one(
+                {"_id": SCHEMA_VERSION_ID},
+                {"$set": {"version": version, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+    finally:
+        config_collection.delete_one({"_id": SCHEMA_LOCK_ID, "owner": owner})
+
+def ensure_schema():
+    ensure_indexes()
+    run_migrations()
+
+async def migrate_in_background():
+    """
+    Data migrations run after ready, so a long array move never holds
+    updates at the startup gate; pool reads drain leftover arrays meanwhile.
+    """
+    try:
+        await run_db(run_migrations)
+    finally:
+        config_cache.clear()  # regions and force-sub channels may have just been seeded
 
 # ───────────────── Health Check ───────────────── #
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(b"Bot is Alive!")
+# Served by aiohttp on the bot's own event loop. "/" keeps the old plain
+# answer for uptime pingers; /healthz is liveness, /readyz checks Mongo and
+# the Telegram connection, /metrics is the Prometheus scrape page.
+PORT = int(os.getenv("PORT", "8080"))
+READY_CHECK_TIMEOUT = float(os.getenv("READY_CHECK_TIMEOUT", "2"))
+
+POOL_DEPTH = Gauge("bot_pool_available", "Available entries per pool", ("pool",))
+CODES_LEFT = Gauge("bot_redeem_codes_available", "Redeem codes left")
+SHORTENER_BREAKER_OPEN = Gauge("bot_shortener_breaker_open", "1 while a provider's breaker is open", ("provider",))
+
+async def collect_gauges():
+    """ Refresh the point-in-time gauges (cached counts, so scrapes stay cheap). """
+    for region in await get_regions():
+        POOL_DEPTH.set(await pool_size(region["pool"]), region["pool"])
+    CODES_LEFT.set(await count_codes())
+    for provider in shortener.providers:
+        SHORTENER_BREAKER_OPEN.set(1 if provider.breaker.state == "open" else 0, provider.name)
+
+async def _check_mongo():
+    await asyncio.wait_for(run_db(client.admin.command, "ping"), READY_CHECK_TIMEOUT)
+
+async def readiness() -> dict:
+    checks = {"telegram": bool(Bot.is_connected)}
+    try:
+        await _check_mongo()
+        checks["mongo"] = True
+    except Exception:
+        checks["mongo"] = False
+    # The shortener is reported but not required: we fall back to deep links.
+    checks["shortener"] = any(p.breaker.state != "open" for p in shortener.providers)
+    checks["accepting"] = lifecycle.ready.is_set() and not lifecycle.draining
+    checks["ready"] = checks["telegram"] and checks["mongo"] and checks["accepting"]
+    if handler_pool is not None:
+        checks["handlers"] = handler_pool.alive()
+        checks["ready"] = checks["ready"] and checks["handlers"] == handler_pool.size
+    return checks
+
+async def handle_root(request):
+    return web.Response(text="Bot is Alive!")
+
+async def handle_healthz(request):
+    return web.Response(text="ok")
+
+async def handle_readyz(request):
+    checks = await readiness()
+    return web.json_response(checks, status=200 if checks["ready"] else 503)
+
+async def handle_metrics(request):
+    try:
+        await collect_gauges()
+    except Exception as e:
+        log.warning("gauge collection failed: %s", e)
+    if handler_pool is not None:
+        lines = merge_metrics(METRICS, await handler_pool.worker_metrics())
+    else:
+        lines = [line for metric in METRICS for line in metric.render()]
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain", charset="utf-8")
+
+async def start_http_server():
+    app = web.Application()
+    app.router.add_get("/", handle_root)
+    app.router.add_get("/healthz", handle_healthz)
+    app.router.add_get("/readyz", handle_readyz)
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    return runner
+
+# ───────────────── Per-user dispatch ───────────────── #
+# A group -1 handler takes every message and callback query off Pyrogram's
+# dispatcher and queues it per user: one user's updates run strictly one after
+# another (no racing double taps or key-prompt replies), different users run
+# in parallel up to USER_DISPATCH_WORKERS handlers at once. A callback whose
+# callback_data is already queued or running for that user is answered and
+# dropped instead of running twice. Negative groups hold this plumbing and
+# are skipped when the update is finally dispatched.
+USER_DISPATCH_WORKERS = int(os.getenv("USER_DISPATCH_WORKERS", "64"))
+USER_QUEUE_LIMIT = int(os.getenv("USER_QUEUE_LIMIT", "20"))
+USER_QUEUE_WAIT = Histogram("bot_user_queue_wait_seconds", "Time an update waited in its user's queue", ("kind",))
+USER_QUEUE_DEPTH = Gauge("bot_user_queue_depth", "Updates queued behind their user's running update")
+USER_UPDATES_COALESCED = Counter("bot_user_updates_coalesced_total", "Duplicate callback taps dropped while in flight")
+USER_UPDATES_DROPPED = Counter("bot_user_updates_dropped_total", "Updates dropped because the user's queue was full")
+
+async def dispatch_update(client, update):
+    """ Run a parsed Message/CallbackQuery through the registered handlers, like Pyrogram's dispatcher. """
+    handler_type = CallbackQueryHandler if isinstance(update, CallbackQuery) else MessageHandler
+    for group_id, group in list(client.dispatcher.groups.items()):
+        if group_id < 0:
+            continue
+        for handler in group:
+            if type(handler) is not handler_type:
+                continue
+            try:
+                if not await handler.check(client, update):
+                    continue
+            except Exception:
+                log.exception("filter of %s failed", handler.callback.__name__)
+                continue
+            try:
+                await handler.callback(client, update)
+            except StopPropagation:
+                return
+            except ContinuePropagation:
+                continue
+            except Exception:
+                log.exception("handler %s failed", handler.callback.__name__)
+            break
+
+class UserDispatcher:
+    def __init__(self, workers: int, queue_limit: int):
+        self.queue_limit = queue_limit
+        self._slots = asyncio.Semaphore(workers)
+        self._queues = {}    # user id -> deque of (update, enqueued)
+        self._pending = {}   # user id -> callback_data queued or running
+        self._drainers = {}  # user id -> task working through that user's queue
+
+    def submit(self, client, update):
+        if lifecycle.draining:
+            # Intake stops here; everything accepted before still runs to
+            # completion.
+            spawn(_turn_away(update, "draining"), "turn-away")
+            return
+        user = update.from_user or getattr(update, "chat", None)
+        user_id = user.id if user else 0
+        data = update.data if isinstance(update, CallbackQuery) else None
+        pending = self._pending.setdefault(user_id, collections.Counter())
+        if data is not None and pending[data]:
+            USER_UPDATES_COALESCED.inc()
+            spawn(self._quietly(update.answer()), "answer-coalesced")  # stop the button spinner
+            return
+        q = self._queues.setdefault(user_id, collections.deque())
+        if len(q) >= self.queue_limit:
+            USER_UPDATES_DROPPED.inc()
+            return
+        if data is not None:
+            pending[data] += 1
+        q.append((update, time.monotonic()))
+        USER_QUEUE_DEPTH.inc()
+        lifecycle.enter()  # accepted: shutdown waits for it like a running handler
+        if user_id not in self._drainers:
+            self._drainers[user_id] = asyncio.create_task(self._drain(client, user_id))
+
+    @staticmethod
+    async def _quietly(coro):
+        # An expired query can't be answered; that is routine, not an error.
+        try:
+            await coro
+        except Exception as e:
+            log.debug("answering a coalesced tap failed: %s", e)
 
-    def do_HEAD(self):
-        self.send_response(200)
-        self.end_headers()
+    async def _drain(self, client, user_id: int):
+        q = self._queues[user_id]
+        pending = self._pending[user_id]
+        try:
+            while q:
+                update, enqueued = q.popleft()
+                USER_QUEUE_DEPTH.dec()
+                try:
+                    async with self._slots:
+                        USER_QUEUE_WAIT.observe(time.monotonic() - enqueued, type(update).__name__)
+                        await dispatch_update(client, update)
+                finally:
+                    if isinstance(update, CallbackQuery):
+                        pending[update.data] -= 1
+                        if pending[update.data] <= 0:
+                            del pending[update.data]
+                    lifecycle.leave()
+        finally:
+            del self._drainers[user_id]
+            if not q:
+                self._queues.pop(user_id, None)
+                self._pending.pop(user_id, None)
+
+user_dispatcher = UserDispatcher(USER_DISPATCH_WORKERS, USER_QUEUE_LIMIT)
+
+@Bot.on_message(group=-1)
+@Bot.on_callback_query(group=-1)
+async def intercept_update(bot, update):
+    user_dispatcher.submit(bot, update)
+    raise StopPropagation
+
+# ───────────────── Handler process pool ───────────────── #
+# DEPLOY_MODE=pool spreads handlers over DEPLOY_WORKERS processes on one
+# machine. Only the receiver consumes updates, and it never parses the ones it
+# routes: HandlerPool replaces Pyrogram's parser for message and callback
+# updates with one that serializes the raw update (TL bytes plus the users and
+# chats it references) onto the multiprocessing queue of worker user_id % N.
+# That keeps every user's updates in order on one worker. A worker rebuilds
+# the pyrogram objects, hands them to its user_dispatcher (same per-user
+# ordering and budget as single mode) and replies over its own MTProto
+# session. Workers serve their metrics on a unix socket; the receiver's
+# /metrics merges them in with a worker label.
+DEPLOY_QUEUE_SIZE = int(os.getenv("DEPLOY_QUEUE_SIZE", "10000"))
+# The receiver routes on one task, so a full queue may only hold it this long.
+DEPLOY_PUT_TIMEOUT = float(os.getenv("DEPLOY_PUT_TIMEOUT", "0.5"))
+DEPLOY_SUPERVISE_INTERVAL = float(os.getenv("DEPLOY_SUPERVISE_INTERVAL", "2"))
+ROUTED_UPDATES = (raw.types.UpdateNewMessage, raw.types.UpdateBotCallbackQuery)
+UPDATES_ROUTED = Counter("bot_updates_routed_total", "Updates handed to a handler process", ("worker",))
+UPDATES_ROUTE_DROPPED = Counter("bot_updates_route_dropped_total", "Updates dropped because a handler queue stayed full", ("worker",))
+HANDLER_RESTARTS = Counter("bot_handler_process_restarts_total", "Handler processes respawned after dying", ("worker",))
+
+def routing_key(update):
+    """ User (or chat) id a raw update belongs to; None for updates we don't route. """
+    if isinstance(update, raw.types.UpdateBotCallbackQuery):
+        return update.user_id
+    if isinstance(update, raw.types.UpdateNewMessage):
+        peer = getattr(update.message, "from_id", None) or getattr(update.message, "peer_id", None)
+        return getattr(peer, "user_id", None) or getattr(peer, "chat_id", None) or getattr(peer, "channel_id", None)
+    return None
 
-def run_server():
-    server = HTTPServer(("0.0.0.0", 8080), HealthCheckHandler)
-    server.serve_forever()
+def encode_update(update, users: dict, chats: dict) -> tuple:
+    return update.write(), [u.write() for u in users.values()], [c.write() for c in chats.values()]
+
+def decode_update(packet: tuple):
+    data, users, chats = packet
+    update = raw.core.TLObject.read(io.BytesIO(data))
+    users = [raw.core.TLObject.read(io.BytesIO(u)) for u in users]
+    chats = [raw.core.TLObject.read(io.BytesIO(c)) for c in chats]
+    return update, users, chats
+
+def worker_metrics_path(index: int) -> str:
+    return os.path.join(tempfile.gettempdir(), f"ffaccount-{os.getppid() if BOT_ROLE == 'worker' else os.getpid()}-{index}.sock")
+
+def _add_label(line: str, label: str) -> str:
+    """ 'name{a="b"} 1' -> 'name{a="b",<label>} 1' """
+    series, _, value = line.rpartition(" ")
+    if series.endswith("}"):
+        return f"{series[:-1]},{label}}} {value}"
+    return f"{series}{{{label}}} {value}"
+
+def merge_metrics(own: list, workers: dict) -> list:
+    """ own: this process's METRICS; workers: index -> their /metrics text. Samples are grouped per family. """
+    samples = collections.defaultdict(list)
+    for index, text in workers.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                family = line.split()[2]
+            elif line and not line.startswith("#") and family:
+                samples[family].append(_add_label(line, f'worker="{index}"'))
+    lines = []
+    for metric in own:
+        rendered = metric.render()
+        lines.extend(rendered[:2])
+        lines.extend(_add_label(line, 'worker="receiver"') for line in rendered[2:])
+        lines.extend(samples.get(metric.name, ()))
+    return lines
+
+class HandlerPool:
+    """ Receiver side: spawns and supervises the handler processes and routes updates to them. """
+
+    def __init__(self, size: int, queue_size: int):
+        self.size = size
+        self.queue_size = queue_size
+        self.queues = [None] * size
+        self.processes = [None] * size
+        self.closed = False
+        self._ctx = multiprocessing.get_context("spawn")
+        self._supervisor = None
+
+    def _spawn(self, index: int):
+        # A fresh queue every time: one whose reader died mid-get may be corrupt.
+        q = self._ctx.Queue(self.queue_size)
+        process = self._ctx.Process(target=run_worker, args=(q,), name=f"handler-{index}")
+        process.start()
+        self.queues[index] = q
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.size):
+            self._spawn(index)
+        parsers = Bot.dispatcher.update_parsers
+        for update_type in ROUTED_UPDATES:
+            parsers[update_type] = functools.partial(self.route, parsers[update_type])
+        self._supervisor = asyncio.create_task(self._supervise())
+        log.info("started %d handler processes", self.size)
+
+    async def _supervise(self):
+        while not self.closed:
+            await asyncio.sleep(DEPLOY_SUPERVISE_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if self.closed or process.is_alive():
+                    continue
+                log.error("%s died (exit code %s), restarting it", process.name, process.exitcode)
+                HANDLER_RESTARTS.inc(str(index))
+                self._spawn(index)
+
+    async def route(self, parse, update, users, chats):
+        """
+        Stands in for Pyrogram's parser of ROUTED_UPDATES: ships the raw update
+        to its worker and raises StopPropagation, which the dispatcher swallows,
+        so nothing is parsed (or fetched) here.
+        """
+        user_id = routing_key(update)
+        if user_id is None or self.closed:
+            # Unroutable, or draining: let this process's own handlers deal with it.
+            return await parse(update, users, chats)
+        index = user_id % self.size
+        packet = encode_update(update, users, chats)
+        q = self.queues[index]
+        try:
+            q.put_nowait(packet)
+        except queue.Full:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, q.put, packet, True, DEPLOY_PUT_TIMEOUT)
+            except queue.Full:
+                # Worker stuck or dead: drop this update rather than stall every other shard.
+                UPDATES_ROUTE_DROPPED.inc(str(index))
+                raise StopPropagation
+        UPDATES_ROUTED.inc(str(index))
+        raise StopPropagation
+
+    def alive(self) -> int:
+        return sum(p.is_alive() for p in self.processes)
+
+    async def worker_metrics(self) -> dict:
+        """ index -> /metrics text of every worker that answered within READY_CHECK_TIMEOUT. """
+        async def fetch(index):
+            connector = aiohttp.UnixConnector(path=worker_metrics_path(index))
+            async with aiohttp.ClientSession(connector=connector) as session:
+                async with session.get("http://worker/metrics", timeout=aiohttp.ClientTimeout(total=READY_CHECK_TIMEOUT)) as resp:
+                    return await resp.text()
+
+        results = await asyncio.gather(*(fetch(i) for i in range(self.size)), return_exceptions=True)
+        return {i: text for i, text in enumerate(results) if isinstance(text, str)}
+
+    async def close(self, timeout: float):
+        """ Stop routing, tell every worker to finish its queue, and wait for them. """
+        self.closed = True
+        lifecycle.draining = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        for q, process in zip(self.queues, self.processes):
+            if not process.is_alive():
+                continue
+            try:
+                await loop.run_in_executor(None, q.put, None, True, max(deadline - time.monotonic(), 0.1))
+            except queue.Full:
+                pass  # it will be terminated below
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                log.warning("%s did not stop in time, terminating it", process.name)
+                process.terminate()
+
+handler_pool = HandlerPool(DEPLOY_WORKERS, DEPLOY_QUEUE_SIZE) if BOT_ROLE == "receiver" else None
+
+async def pump_updates(q):
+    """ Worker side: parse routed updates in arrival order and queue them per user, until the sentinel. """
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    def reader():  # blocking multiprocessing reads stay off the event loop
+        while True:
+            packet = q.get()
+            loop.call_soon_threadsafe(inbox.put_nowait, packet)
+            if packet is None:
+                return
+
+    threading.Thread(target=reader, name="update-reader", daemon=True).start()
+    while True:
+        packet = await inbox.get()
+        if packet is None:
+            break
+        try:
+            update, users, chats = decode_update(packet)
+            await Bot.fetch_peers(users + chats)  # so replies can resolve these peers
+            parser = Bot.dispatcher.update_parsers.get(type(update))
+            parsed, _ = await parser(update, {u.id: u for u in users}, {c.id: c for c in chats})
+        except Exception:
+            log.exception("could not decode routed update")
+            continue
+        user_dispatcher.submit(Bot, parsed)
+
+async def start_worker_metrics():
+    """ Worker side: raw metrics on a unix socket for the receiver's /metrics (no gauge collection). """
+    async def handle(request):
+        lines = [line for metric in METRICS for line in metric.render()]
+        return web.Response(text="\n".join(lines) + "\n", content_type="text/plain", charset="utf-8")
+
+    path = worker_metrics_path(WORKER_INDEX)
+    if os.path.exists(path):
+        os.unlink(path)  # left behind by the worker this one replaces
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.UnixSite(runner, path).start()
+    return runner
+
+async def worker_main(q):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lifecycle.stopping.set)
+    pump = None
+    metrics_runner = await start_worker_metrics()
+    try:
+        await startup()
+        pump = asyncio.create_task(pump_updates(q))
+        stop_signal = asyncio.create_task(lifecycle.stopping.wait())
+        await asyncio.wait({pump, stop_signal}, return_when=asyncio.FIRST_COMPLETED)
+        stop_signal.cancel()
+        # The receiver sends the sentinel once it stops routing; give it half the budget.
+        await asyncio.wait({pump}, timeout=SHUTDOWN_DEADLINE / 2)
+    finally:
+        if pump is not None:
+            pump.cancel()
+        await shutdown()
+        await metrics_runner.cleanup()
+
+def run_worker(q):
+    """ Entry point of a handler process. """
+    Bot.run(worker_main(q))
 
 # ───────────────── Main ───────────────── #
+async def timed_phase(phase: str, coro):
+    started = time.monotonic()
+    try:
+        return await coro
+    finally:
+        STARTUP_SECONDS.set(time.monotonic() - started, phase)
+
+async def start_mongo():
+    # Indexes only: data migrations run after ready (see migrate_in_background).
+    await run_db(ensure_indexes)
+    # Warm the caches every first update needs.
+    await asyncio.gather(get_regions(), get_current_admin_key())
+
+async def start_telegram():
+    global BOT_USERNAME
+    await Bot.start()
+    BOT_USERNAME = (await Bot.get_me()).username
+
+async def startup():
+    """ Independent startup steps run concurrently; handlers are gated until they all finish. """
+    started = time.monotonic()
+    outbox.start()
+    user_writer.start()
+    analytics.start()
+    code_lease.start()
+    shortener._get_session()
+    await asyncio.gather(
+        timed_phase("mongo", start_mongo()),
+        timed_phase("telegram", start_telegram()),
+    )
+    lifecycle.ready.set()
+    STARTUP_SECONDS.set(time.monotonic() - started, "startup")
+    STARTUP_SECONDS.set(time.monotonic() - PROCESS_STARTED, "total")
+    log.info(
+        "ready in %.0f ms (%.0f ms since process start)",
+        (time.monotonic() - started) * 1000, (time.monotonic() - PROCESS_STARTED) * 1000
+    )
+    # Background work that handlers do not depend on.
+    spawn(migrate_in_background(), "migrations")
+    if HANDLES_UPDATES:
+        token_reserve.start()
+        spawn(preload_seen_users(), "preload-seen-users")
+    if RUNS_BROADCASTS:
+        await resume_broadcasts(Bot)
+    if handler_pool is not None:
+        spawn(poll_broadcasts(Bot), "poll-broadcasts")
+    if CONFIG_WATCH:
+        config_cache.start_watch()
+
+async def shutdown():
+    """ Stop intake, drain handlers, flush buffers, then close connections; bounded by SHUTDOWN_DEADLINE. """
+    started = time.monotonic()
+    deadline = started + SHUTDOWN_DEADLINE
+    lifecycle.draining = True
+    config_cache.stop_watch()
+    await token_reserve.stop()
+    # Running broadcasts resume from their last checkpoint in the next process.
+    for task in list(BROADCAST_TASKS.values()):
+        task.cancel()
+    if not await lifecycle.drained(deadline - time.monotonic()):
+        log.warning("shutdown deadline hit with %d handlers still running", lifecycle.in_flight)
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(user_writer.stop(), analytics.stop(), code_lease.stop()),
+            max(deadline - time.monotonic(), 1)
+        )
+    except asyncio.TimeoutError:
+        log.warning("buffered writes did not finish before the shutdown deadline")
+    for task in list(_background):
+        task.cancel()
+    await outbox.stop()
+    await shortener.close()
+    if Bot.is_connected:
+        await Bot.stop()
+    log.info("shutdown finished in %.1fs", time.monotonic() - started)
+
+async def main():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lifecycle.stopping.set)
+    # Health endpoints first, so the platform sees the process while it starts.
+    http_runner = await start_http_server()
+    if handler_pool is not None:
+        handler_pool.start()
+    try:
+        await startup()
+        await lifecycle.stopping.wait()
+        log.info("stop signal received, draining %d handlers", lifecycle.in_flight)
+    finally:
+        if handler_pool is not None:
+            await handler_pool.close(SHUTDOWN_DEADLINE * 0.8)
+        await shutdown()
+        await http_runner.cleanup()
+
 if __name__ == "__main__":
-    threading.Thread(target=run_server, daemon=True).start()
-    Bot.run()
+    Bot.run(main())